@@ -0,0 +1,120 @@
+import os
+import collections
+
+from PyFileScanner import NINE_PATCH_EXTENSION
+
+# Android density qualifier -> dots per inch, mdpi is the baseline
+DENSITIES = collections.OrderedDict([
+    ('ldpi', 120),
+    ('mdpi', 160),
+    ('tvdpi', 213),
+    ('hdpi', 240),
+    ('xhdpi', 320),
+    ('xxhdpi', 480),
+    ('xxxhdpi', 640),
+])
+BASELINE_DENSITY = 'mdpi'
+# qualifiers of images not scaled by density
+DENSITY_INDEPENDENT = ('nodpi', 'anydpi')
+
+def folder_density(path):
+    """
+    Return density qualifier of the folder holding path, e.g. 'xhdpi' for
+    res/drawable-xhdpi-v4/icon.png or ui/xhdpi/icon.png, '' if the folder has none
+    """
+    folder = os.path.basename(os.path.dirname(path)).lower()
+    for qualifier in folder.split('-'):
+        if qualifier in DENSITIES or qualifier in DENSITY_INDEPENDENT:
+            return qualifier
+    return ''
+
+def resource_name(path):
+    """
+    Return logical resource name of path, file name without extension, '.9.png' included
+    """
+    filename = os.path.basename(path)
+    if filename.lower().endswith(NINE_PATCH_EXTENSION):
+        return filename[:-len(NINE_PATCH_EXTENSION)]
+    return os.path.splitext(filename)[0]
+
+def densities_match(density1, density2):
+    """
+    Return whether images of two density qualifiers are worth a pixel compare,
+    folders without a density qualifier match any density
+    """
+    return density1 == density2 or '' == density1 or '' == density2
+
+def density_scale(density, target = BASELINE_DENSITY):
+    """
+    Return the factor images of density are scaled by to target density, 1.0 for unknown densities
+    """
+    if not density in DENSITIES or not target in DENSITIES:
+        return 1.0
+    return DENSITIES[target] / DENSITIES[density]
+
+def canonical_size(width, height, density, target = BASELINE_DENSITY):
+    """
+    Return (width, height) of an image of density once scaled to target density
+    """
+    scale = density_scale(density, target)
+    return (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+
+class ResourceTable(object):
+    """
+    Density aware model of image resources, files are grouped by logical name and by density qualifier
+    so an image is only compared against files of a matching density
+    Args:
+        files (list): image file paths
+    """
+    def __init__(self, files):
+        self.files = list(files)
+        # path -> density qualifier
+        self.densities = dict()
+        # density -> [path], in files order
+        self.density_dict = dict()
+        # resource name -> {density: [path]}
+        self.groups = dict()
+        # density -> [path] of every density matching it, in files order
+        self.candidate_dict = dict()
+        for file in self.files:
+            density = folder_density(file)
+            self.densities[file] = density
+            self.density_dict.setdefault(density, []).append(file)
+            self.groups.setdefault(resource_name(file), dict()).setdefault(density, []).append(file)
+
+    def density(self, file):
+        density = self.densities.get(file)
+        if density is None:
+            density = folder_density(file)
+        return density
+
+    def buckets(self, density):
+        """
+        Return the densities of the table matching density
+        """
+        return [other for other in self.density_dict if densities_match(density, other)]
+
+    def candidates(self, imagepath, files = None):
+        """
+        Return files of a density matching imagepath, every table file when files is None.
+        Order of files is kept, the table files matching a density are only listed once.
+        """
+        density = folder_density(imagepath)
+        if files is None:
+            if '' == density:
+                return self.files
+            candidates = self.candidate_dict.get(density)
+            if candidates is None:
+                buckets = set(self.buckets(density))
+                candidates = self.candidate_dict[density] = [file for file in self.files if self.densities[file] in buckets]
+            return candidates
+        return [file for file in files if densities_match(density, self.density(file))]
+
+    def variants(self, imagepath):
+        """
+        Return {density: [path]} of the table files sharing the logical name of imagepath
+        """
+        return self.groups.get(resource_name(imagepath), dict())
+
+    def __len__(self):
+        return len(self.files)
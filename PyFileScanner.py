@@ -0,0 +1,83 @@
+import os
+import collections
+
+NINE_PATCH_EXTENSION = '.9.png'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', NINE_PATCH_EXTENSION)
+
+entry_fields = ['path', 'size', 'mtime', 'ext']
+
+class FileEntry(collections.namedtuple('FileEntry', entry_fields)):
+    pass
+
+def file_extension(filename):
+    """
+    Return lower case extension of filename, '.9.png' for Android 9-patch images
+    """
+    name = filename.lower()
+    if name.endswith(NINE_PATCH_EXTENSION):
+        return NINE_PATCH_EXTENSION
+    return os.path.splitext(name)[1]
+
+def is_image_extension(filename, extensions = IMAGE_EXTENSIONS):
+    return file_extension(filename) in extensions
+
+def scan_folder(folder, extensions = IMAGE_EXTENSIONS, entries = None):
+    """
+    Walk folder once with os.scandir and return FileEntry of every file matching extensions.
+    Files are listed in directory order and sub folders are walked where they are met,
+    the same order a recursive os.listdir walk gives.
+    """
+    if entries is None:
+        entries = []
+    with os.scandir(folder) as iterator:
+        for entry in iterator:
+            if entry.is_dir():
+                scan_folder(entry.path, extensions, entries)
+            elif entry.is_file():
+                ext = file_extension(entry.name)
+                if ext in extensions:
+                    stat = entry.stat()
+                    entries.append(FileEntry(path = entry.path, size = stat.st_size, mtime = stat.st_mtime_ns, ext = ext))
+    return entries
+
+class FileManifest(object):
+    """
+    In memory manifest of image files under folders, walked once and reused by every compare
+    Args:
+        folders (list): folders to scan
+        extensions (tuple): lower case extensions to keep
+    """
+    def __init__(self, folders, extensions = IMAGE_EXTENSIONS):
+        self.folders = folders
+        self.extensions = extensions
+        self.refresh()
+
+    def refresh(self):
+        entries = []
+        for folder in self.folders:
+            scan_folder(folder, self.extensions, entries)
+        self.set_entries(entries)
+
+    def set_entries(self, entries):
+        self.entries = entries
+        # extension -> [FileEntry]
+        self.ext_dict = dict()
+        for entry in self.entries:
+            self.ext_dict.setdefault(entry.ext, []).append(entry)
+
+    def subset(self, keep):
+        """
+        Return a FileManifest of the entries keep(entry) is true for, the folders are not walked again
+        """
+        manifest = FileManifest.__new__(FileManifest)
+        manifest.folders = self.folders
+        manifest.extensions = self.extensions
+        manifest.set_entries([entry for entry in self.entries if keep(entry)])
+        return manifest
+
+    def paths(self, ext = None):
+        entries = self.entries if ext is None else self.ext_dict.get(ext, [])
+        return [entry.path for entry in entries]
+
+    def __len__(self):
+        return len(self.entries)
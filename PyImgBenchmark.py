@@ -0,0 +1,278 @@
+import os
+import sys
+import time
+import zlib
+import struct
+
+from PyImgCmp import *
+
+def make_png(width, height, color = (0, 0, 0, 255)):
+    """
+    Return bytes of a solid color RGBA png file, only need zlib and struct builtin modules
+    """
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    row = b'\x00' + bytes(color) * width
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', zlib.compress(row * height)) + chunk(b'IEND', b'')
+
+def generate_png_folder(folder, count):
+    """
+    Fill folder with count png files of assorted sizes, existing files are kept
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for i in range(count):
+        filepath = os.path.join(folder, 'image_{:05d}.png'.format(i))
+        if not os.path.isfile(filepath):
+            with open(filepath, 'wb') as output:
+                output.write(make_png(16 + i % 48, 16 + i % 32, (i % 256, 0, 0, 255)))
+
+def benchmark_backend(backend: MetadataBackend, files):
+    """
+    Return files per second of backend loading metadata of every file
+    """
+    start = time.perf_counter()
+    for file in files:
+        backend.load(file)
+    elapsed = time.perf_counter() - start
+    return len(files) / elapsed if elapsed > 0 else float('inf')
+
+def benchmark_bulk(files):
+    """
+    Return files per second of PyImgDecoder.get_images_metadata_array over every file
+    """
+    start = time.perf_counter()
+    PyImgDecoder.get_images_metadata_array(files)
+    elapsed = time.perf_counter() - start
+    return len(files) / elapsed if elapsed > 0 else float('inf')
+
+BENCHMARK_VERSION = 1
+# density qualifier -> scale of the mdpi size
+SKIN_DENSITIES = [('mdpi', 1.0), ('hdpi', 1.5), ('xhdpi', 2.0), ('xxhdpi', 3.0)]
+# how the ui image of a template drawable differs from it, by drawable index
+SKIN_VARIANTS = ['same', 'shifted', 'resized', 'renamed']
+
+def make_icon(rng, size):
+    """
+    Return a BGRA icon of random filled shapes on a transparent background, drawn at size x size
+    """
+    import cv2
+    import numpy
+    img = numpy.zeros((size, size, 4), numpy.uint8)
+    for shape in range(3):
+        color = tuple(int(value) for value in rng.randint(0, 256, 3)) + (255,)
+        center = tuple(int(value) for value in rng.randint(size // 4, size * 3 // 4, 2))
+        if shape % 2 == 0:
+            cv2.circle(img, center, int(rng.randint(size // 8, size // 3)), color, -1)
+        else:
+            half = int(rng.randint(size // 8, size // 3))
+            cv2.rectangle(img, (center[0] - half, center[1] - half), (center[0] + half, center[1] + half), color, -1)
+    return cv2.GaussianBlur(img, (3, 3), 0)
+
+def generate_skin_tree(root, count, seed = 0):
+    """
+    Generate a synthetic skin under root: template/res/drawable-<density> holds count drawables
+    per density from mdpi to xxhdpi, ui/<density> holds one variant of each, in turn identical,
+    colour shifted, resized by 10% and renamed. Existing trees are generated again.
+    Returns:
+        dict: template drawable path -> ui path it should match
+    """
+    import cv2
+    import numpy
+    rng = numpy.random.RandomState(seed)
+    truth = dict()
+    if os.path.isdir(root):
+        import shutil
+        shutil.rmtree(root)
+    for i in range(count):
+        mdpi_size = 24 + (i % 5) * 8
+        master = make_icon(rng, int(mdpi_size * SKIN_DENSITIES[-1][1]))
+        variant = SKIN_VARIANTS[i % len(SKIN_VARIANTS)]
+        for density, scale in SKIN_DENSITIES:
+            template_folder = os.path.join(root, 'template', 'res', 'drawable-' + density)
+            ui_folder = os.path.join(root, 'ui', density)
+            for folder in (template_folder, ui_folder):
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+            size = int(mdpi_size * scale)
+            img = cv2.resize(master, (size, size), interpolation=cv2.INTER_AREA)
+            filename = 'asset_{:04d}.png'.format(i)
+            ui_img = img
+            ui_filename = filename
+            if 'shifted' == variant:
+                ui_img = img.copy()
+                ui_img[:, :, :3] = numpy.clip(img[:, :, :3].astype(numpy.int16) + (24, 0, -24), 0, 255).astype(numpy.uint8)
+            elif 'resized' == variant:
+                resized = int(round(size * 1.1))
+                ui_img = cv2.resize(img, (resized, resized), interpolation=cv2.INTER_LINEAR)
+            elif 'renamed' == variant:
+                ui_filename = 'renamed_{:04d}.png'.format(i)
+            template_file = os.path.join(template_folder, filename)
+            ui_file = os.path.join(ui_folder, ui_filename)
+            cv2.imwrite(template_file, img)
+            cv2.imwrite(ui_file, ui_img)
+            truth[template_file] = ui_file
+    return truth
+
+def peak_rss_kb():
+    """
+    Return peak resident set size of the whole process so far in KiB, the peak working set on Windows,
+    None where neither can be read. It never goes down, a case only shows up if it raised the peak.
+    """
+    if 'win32' == sys.platform:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize // 1024
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if 'darwin' == sys.platform else rss
+
+def percentiles(values, points = (50, 95, 99)):
+    """
+    Return {'p<point>': value} of nearest rank percentiles of values
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return dict(('p{:d}'.format(point), None) for point in points)
+    return dict(('p{:d}'.format(point), ordered[min(len(ordered) - 1, max(0, int(round(point / 100.0 * len(ordered))) - 1))]) for point in points)
+
+def stage_report(count, elapsed, latencies, matched, total):
+    return dict(count = count, seconds = elapsed,
+                throughput = count / elapsed if elapsed > 0 else None,
+                latency_ms = percentiles([latency * 1000 for latency in latencies]),
+                accuracy = matched / total if total else None,
+                process_peak_rss_kb = peak_rss_kb())
+
+def benchmark_pair_comparater(compare, truth):
+    """
+    Compare every template drawable against every ui image of its density with compare(left, right),
+    which returns a diff, lower is better and negative for no match. A drawable is matched when
+    its best diff is its ui variant.
+    """
+    rights = dict()
+    for left, right in truth.items():
+        rights.setdefault(os.path.dirname(left).rsplit('-', 1)[-1], []).append(right)
+    latencies = []
+    matched = 0
+    start = time.perf_counter()
+    for left, expected in truth.items():
+        best = None
+        for right in rights[os.path.dirname(left).rsplit('-', 1)[-1]]:
+            pair_start = time.perf_counter()
+            diff = compare(left, right)
+            latencies.append(time.perf_counter() - pair_start)
+            if diff >= 0 and (best is None or diff < best[0]):
+                best = (diff, right)
+        if not best is None and best[1] == expected:
+            matched += 1
+    elapsed = time.perf_counter() - start
+    return stage_report(len(latencies), elapsed, latencies, matched, len(truth))
+
+class BenchmarkPrinter(ResultPrinter):
+    """
+    Keep the best result of every file compare task and the time between tasks
+    """
+    def __init__(self):
+        self.results = dict()
+        self.latencies = []
+        self.last = time.perf_counter()
+
+    def print(self, compare_task: ImageFileCompareTask):
+        now = time.perf_counter()
+        self.latencies.append(now - self.last)
+        self.last = now
+        for results_list in [compare_task.equal_list, compare_task.similar_list, compare_task.error_list]:
+            if not len(results_list) == 0:
+                self.results[compare_task.imagefile] = results_list[0]
+                return
+
+def benchmark_folder_task(root, truth, density_aware = False):
+    """
+    Run ImageFolderCompareTask of the template drawable folders against the ui folder end to end,
+    accuracy counts drawables whose first equal result is their ui variant
+    """
+    import io
+    import contextlib
+    template_res = os.path.join(root, 'template', 'res')
+    folders = [os.path.join(template_res, folder) for folder in sorted(os.listdir(template_res))]
+    printer = BenchmarkPrinter()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        task = ImageFolderCompareTask(folders, [os.path.join(root, 'ui')], printer, get_metadata_backend('struct'), density_aware = density_aware)
+        printer.last = time.perf_counter()
+        task.start()
+    elapsed = time.perf_counter() - start
+    results = printer.results.values()
+    matched = sum(1 for result in results if result.code == FileCompareResult.CODE_SUCCESS and result.otherfile == truth.get(result.imagefile))
+    report = stage_report(len(printer.latencies), elapsed, printer.latencies, matched, len(truth))
+    equal_results = [result for result in results if result.code == FileCompareResult.CODE_SUCCESS]
+    report['correct'] = sum(1 for result in equal_results if result.correct()) / len(equal_results) if equal_results else None
+    return report
+
+def benchmark_skin(root, count = 24, seed = 0):
+    """
+    Return {benchmark name: report} of every comparater and the folder compare task on a synthetic skin tree
+    """
+    truth = generate_skin_tree(root, count, seed)
+    reports = dict()
+    simple = ImageSimpleComparater(get_metadata_backend('struct'))
+    reports['ImageSimpleComparater'] = benchmark_pair_comparater(
+        lambda left, right: simple.calculate_diff(left, right).diff, truth)
+    # PyProject01 needs skimage and imagehash, imported only for these benchmarks
+    from PyProject01 import ImageHashComparater, ImageHistComparater, ImageSSIMComparater
+    for comparater in [ImageHashComparater(), ImageHistComparater(), ImageSSIMComparater()]:
+        reports[type(comparater).__name__] = benchmark_pair_comparater(comparater.compare_image, truth)
+    reports['ImageFolderCompareTask'] = benchmark_folder_task(root, truth)
+    reports['ImageFolderCompareTask.density'] = benchmark_folder_task(root, truth, density_aware = True)
+    return reports
+
+def write_report(filepath, config, reports):
+    """
+    Write reports to a json file, keys are sorted so runs of two versions diff cleanly
+    """
+    import json
+    import platform
+    content = dict(version = BENCHMARK_VERSION, python = platform.python_version(), platform = platform.platform(), config = config, results = reports)
+    with open(filepath, 'w') as output:
+        json.dump(content, output, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    bench_folder = sys.argv[1] if len(sys.argv) > 1 else 'bench_pngs'
+    report_file = sys.argv[2] if len(sys.argv) > 2 else 'benchmark.json'
+    bench_count = 10000
+    skin_folder = bench_folder + '_skin'
+    skin_count = 24
+
+    generate_png_folder(bench_folder, bench_count)
+    files = [os.path.join(bench_folder, file) for file in sorted(os.listdir(bench_folder))]
+    reports = dict()
+    for name in ['struct', 'pil']:
+        files_per_sec = benchmark_backend(get_metadata_backend(name), files)
+        reports['metadata.' + name] = dict(count = len(files), throughput = files_per_sec)
+        print('{:<8} {:d} files, {:.0f} files/sec'.format(name, len(files), files_per_sec))
+    files_per_sec = benchmark_bulk(files)
+    reports['metadata.bulk'] = dict(count = len(files), throughput = files_per_sec)
+    print('{:<8} {:d} files, {:.0f} files/sec'.format('bulk', len(files), files_per_sec))
+
+    for name, report in benchmark_skin(skin_folder, skin_count).items():
+        reports[name] = report
+        print('{:<32} {:>6d} {:>10.1f}/sec p50 {:.3f}ms p95 {:.3f}ms accuracy {:.2f}'.format(
+            name, report['count'], report['throughput'], report['latency_ms']['p50'], report['latency_ms']['p95'], report['accuracy']))
+    write_report(report_file, dict(metadata_count = bench_count, skin_count = skin_count, seed = 0), reports)
+    print('report: ', report_file)
@@ -0,0 +1,154 @@
+import os
+import sys
+import collections
+
+import cv2
+import numpy
+
+import PyImgDecoder
+
+class ImageCache(object):
+    """
+    Memory bounded LRU cache of decoded images and artifacts derived from them,
+    entries are keyed by (path, mtime, size) so a changed file is decoded again.
+    Entries and counters are per process, a process pool worker gets an empty cache
+    of the same budget and its hits and misses are not reported by the parent.
+    Args:
+        max_bytes (int): byte budget of all cached values
+    """
+    IMAGE = 'image'
+
+    def __init__(self, max_bytes = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # only the budget is pickled, decoded images aren't shipped to process pool workers
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def file_key(self, path):
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+    def value_size(self, value):
+        nbytes = getattr(value, 'nbytes', None)
+        if nbytes is None:
+            return sys.getsizeof(value)
+        return nbytes
+
+    def put(self, key, value):
+        size = self.value_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.current_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+
+    def has(self, path, name) -> bool:
+        return self.file_key(path) + (name,) in self.entries
+
+    def set(self, path, name, value):
+        self.put(self.file_key(path) + (name,), value)
+
+    def get(self, path, name, compute):
+        """
+        Return artifact name of path, compute(path) is only called on cache miss
+        """
+        key = self.file_key(path) + (name,)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        value = compute(path)
+        self.put(key, value)
+        return value
+
+    def read_image(self, path):
+        """
+        Return cv2.imread(path, cv2.IMREAD_UNCHANGED), the returned array is shared and read only
+        """
+        return self.get(path, ImageCache.IMAGE, decode_image)
+
+    def read_mode(self, path, mode = 'full', img = None):
+        """
+        Return channels of compare mode of the image of path, extracted once and cached
+        Args:
+            img (numpy.ndarray): decoded image of path already at hand, None to read it from the cache
+        """
+        if 'full' == mode:
+            return self.read_image(path) if img is None else img
+        return self.get(path, 'mode.' + mode, lambda path: extract_channels(self.read_image(path) if img is None else img, mode))
+
+    def clear(self):
+        self.entries.clear()
+        self.current_bytes = 0
+
+    def __str__(self):
+        return 'ImageCache: hits {:d}, misses {:d}, evictions {:d}, entries {:d}, bytes {:d}/{:d}'.format(
+            self.hits, self.misses, self.evictions, len(self.entries), self.current_bytes, self.max_bytes)
+
+def decode_image(path):
+    """
+    Same as cv2.imread(path, cv2.IMREAD_UNCHANGED), the file is read in one call
+    and decoded by cv2.imdecode, both release the GIL. The 1px marker border of
+    source 9-patch images is stripped so they compare by content.
+    """
+    with open(path, 'rb') as input:
+        data = input.read()
+    img = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_UNCHANGED)
+    if img is not None and img.shape[0] > 2 and img.shape[1] > 2 and PyImgDecoder.has_nine_patch_border(path, data):
+        img = img[1:-1, 1:-1]
+    if img is not None:
+        img.flags.writeable = False
+    return img
+
+COMPARE_MODES = ('full', 'bgr', 'alpha', 'gray', 'binary', 'premultiplied')
+
+def extract_channels(img, mode):
+    """
+    Return the channels of img a compare mode looks at, read only
+        full: every channel
+        bgr: color channels without alpha
+        alpha: alpha channel, fully opaque for images without alpha
+        gray: luminance of the color channels
+        binary: 255 where the pixel is visible, alpha for images with alpha, gray otherwise
+        premultiplied: color channels multiplied by alpha
+    Single channel modes return 2d arrays, cheaper to compare than the full image.
+    """
+    if not mode in COMPARE_MODES:
+        raise ValueError('Invalid compare mode {}, must be one of {}'.format(mode, list(COMPARE_MODES)))
+    if img is None or 'full' == mode:
+        return img
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    max_value = numpy.iinfo(img.dtype).max if numpy.issubdtype(img.dtype, numpy.integer) else 1.0
+    if 'bgr' == mode:
+        result = img if channels < 4 else img[:, :, :3]
+    elif 'alpha' == mode:
+        result = img[:, :, 3] if channels == 4 else numpy.full(img.shape[:2], max_value, img.dtype)
+    elif 'gray' == mode:
+        result = img if channels == 1 else cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if channels == 4 else cv2.COLOR_BGR2GRAY)
+    elif 'binary' == mode:
+        visible = img[:, :, 3] if channels == 4 else extract_channels(img, 'gray')
+        result = numpy.where(visible.reshape(img.shape[:2]) > 0, 255, 0).astype(numpy.uint8)
+    else:
+        if channels < 4:
+            result = img
+        else:
+            alpha = img[:, :, 3:4].astype(numpy.float32) / max_value
+            result = numpy.rint(img[:, :, :3] * alpha).astype(img.dtype)
+    result = numpy.ascontiguousarray(result)
+    result.flags.writeable = False
+    return result
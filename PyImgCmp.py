@@ -1,13 +1,28 @@
 import os
-from PIL import Image
+import io
+import json
+import time
+import struct
+import hashlib
+import PyImgDecoder
+from PyTopK import TopKCollector
+from PyImgStore import ComparisonStore
+from PyFileScanner import FileManifest, scan_folder, is_image_extension, file_extension, NINE_PATCH_EXTENSION
+from PyAndroidRes import folder_density, densities_match
 
 from openpyxl import Workbook
 from openpyxl import load_workbook
 from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.utils import get_column_letter
 
 from openpyxl.styles import Color, PatternFill
 
 import collections
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 image_fields = ['path', 'type', 'width', 'height', 'mode']
 
 class ImageInfo(collections.namedtuple('ImageInfo', image_fields)):
@@ -54,14 +69,11 @@ class ImageCompareResult(FileCompareResult):
         return '{},{},{:.10f},f:{},w:{:d},h:{:d},m:{},{}'.format(self.imagefile, self.otherfile, self.diff, self.image.type, self.image.width, self.image.height, self.image.mode, self.reason)
 
     def iterator(self):
-        return str(self).split(',')
+        return [self.imagefile, self.otherfile, '{:.10f}'.format(self.diff), 'f:{}'.format(self.image.type),
+                'w:{:d}'.format(self.image.width), 'h:{:d}'.format(self.image.height), 'm:{}'.format(self.image.mode), self.reason]
 
     def correct(self) -> bool:
-        split = self.imagefile.split('\\')
-        imagefile_name = split[len(split) - 1]
-        split = self.otherfile.split('\\')
-        otherfile_name = split[len(split) - 1]
-        return imagefile_name == otherfile_name
+        return os.path.basename(self.imagefile) == os.path.basename(self.otherfile)
 
 class ImageComparater(object):
     IGNORE_DIFF_SCORE = -1
@@ -70,39 +82,383 @@ class ImageComparater(object):
     def calculate_diff(self, imagefile1, imagefile2) -> ImageCompareResult:
         return ImageCompareResult('', '', ImageComparater.EQUAL_DIFF_SCORE, [], FileCompareResult.CODE_SUCCESS)
 
+    def report(self):
+        return None
+
+class MetadataBackend(object):
+    def load(self, imagefile) -> ImageInfo:
+        pass
+
+class PilMetadataBackend(MetadataBackend):
+    def load(self, imagefile) -> ImageInfo:
+        from PIL import Image
+        img = Image.open(imagefile)
+        imginfo = ImageInfo(path = imagefile, type = img.format, width = img.width, height = img.height, mode = img.mode)
+        img.close()
+        return imginfo
+
+class StructMetadataBackend(MetadataBackend):
+    """
+    Read format and dimensions from image headers with PyImgDecoder,
+    fall back to PIL for unknown formats, and for mode of non PNG images when resolve_mode is set
+    """
+    # (bit depth, color type) of PNG IHDR chunk -> PIL mode
+    PNG_MODES = {
+        (1, 0): '1', (2, 0): 'L', (4, 0): 'L', (8, 0): 'L', (16, 0): 'I;16',
+        (8, 2): 'RGB', (16, 2): 'RGB',
+        (1, 3): 'P', (2, 3): 'P', (4, 3): 'P', (8, 3): 'P',
+        (8, 4): 'LA', (16, 4): 'RGBA',
+        (8, 6): 'RGBA', (16, 6): 'RGBA',
+    }
+    HEADER_TYPES = (PyImgDecoder.PNG, PyImgDecoder.JPEG, PyImgDecoder.GIF, PyImgDecoder.BMP, PyImgDecoder.WEBP)
+
+    def __init__(self, resolve_mode = True):
+        self.resolve_mode = resolve_mode
+        self.fallback = PilMetadataBackend()
+
+    def load(self, imagefile) -> ImageInfo:
+        try:
+            img, data = PyImgDecoder.read_image_metadata(imagefile)
+        except (PyImgDecoder.UnknownImageFormat, struct.error):
+            return self.fallback.load(imagefile)
+        if not img.type in StructMetadataBackend.HEADER_TYPES:
+            return self.fallback.load(imagefile)
+        mode = None
+        if PyImgDecoder.PNG == img.type:
+            mode = StructMetadataBackend.PNG_MODES.get(tuple(data[24:26]))
+        elif PyImgDecoder.WEBP == img.type:
+            mode = 'RGBA' if PyImgDecoder.get_webp_has_alpha(data) else 'RGB'
+        if mode is None and self.resolve_mode:
+            mode = self.fallback.load(imagefile).mode
+        return ImageInfo(path = imagefile, type = img.type, width = img.width, height = img.height, mode = mode)
+
+class StoreMetadataBackend(MetadataBackend):
+    """
+    Keep image info loaded by another backend in a ComparisonStore across runs
+    """
+    VERSION = 1
+
+    def __init__(self, backend: MetadataBackend, store: ComparisonStore):
+        self.backend = backend
+        self.store = store
+        self.kind = 'info.{}'.format(type(backend).__name__)
+
+    def load(self, imagefile) -> ImageInfo:
+        value = self.store.get_file(imagefile, self.kind, StoreMetadataBackend.VERSION)
+        if not value is None:
+            type, width, height, mode = json.loads(value)
+            return ImageInfo(path = imagefile, type = type, width = width, height = height, mode = mode)
+        imginfo = self.backend.load(imagefile)
+        self.store.put_file(imagefile, self.kind, json.dumps([imginfo.type, imginfo.width, imginfo.height, imginfo.mode]), StoreMetadataBackend.VERSION)
+        return imginfo
+
+METADATA_BACKENDS = {
+    'pil': PilMetadataBackend,
+    'struct': StructMetadataBackend,
+}
+
+def get_metadata_backend(name = 'pil') -> MetadataBackend:
+    if not name in METADATA_BACKENDS:
+        raise ValueError('Invalid metadata backend {}, must be one of {}'.format(name, list(METADATA_BACKENDS)))
+    return METADATA_BACKENDS[name]()
+
+default_backend = PilMetadataBackend()
+
+def load_image_info(imagefile, backend: MetadataBackend = None) -> ImageInfo:
+    if backend is None:
+        backend = default_backend
+    return backend.load(imagefile)
+
 class ImageSimpleComparater(ImageComparater):
+    def __init__(self, backend: MetadataBackend = None):
+        self.backend = backend
+
     def calculate_diff(self, imagefile1, imagefile2):
-        img1 = Image.open(imagefile1)
-        img2 = Image.open(imagefile2)
-        imginfo1 = ImageInfo(path = imagefile1, type = img1.format, width = img1.width, height = img1.height, mode = img1.mode)
-        imginfo2 = ImageInfo(path = imagefile2, type = img2.format, width = img2.width, height = img2.height, mode = img2.mode)
-        img1.close()
-        img2.close()
+        imginfo1 = load_image_info(imagefile1, self.backend)
+        imginfo2 = load_image_info(imagefile2, self.backend)
         if not imginfo1.type == imginfo2.type or not imginfo1.width == imginfo2.width or not imginfo1.height == imginfo2.height:
             return ImageCompareResult(imagefile1, imagefile2, ImageComparater.IGNORE_DIFF_SCORE, imginfo1, FileCompareResult.CODE_WARN, 'simple image info not match')
-        splits = imagefile1.split('\\')
-        filename1 = splits[len(splits) - 1]
-        splits = imagefile2.split('\\')
-        filename2 = splits[len(splits) - 1]
+        filename1 = os.path.basename(imagefile1)
+        filename2 = os.path.basename(imagefile2)
         if filename1 == filename2:
             return ImageCompareResult(imagefile1, imagefile2, ImageComparater.EQUAL_DIFF_SCORE, imginfo1)
         else:
             return ImageCompareResult(imagefile1, imagefile2, ImageComparater.IGNORE_DIFF_SCORE, imginfo1, FileCompareResult.CODE_ERROR, 'filename not match')
 
+class ComparePair(object):
+    """
+    State of one pair shared by the stages of ImageCascadeComparater, computed on demand
+    """
+    def __init__(self, cascade, imagefile1, imagefile2):
+        self.cascade = cascade
+        self.imagefiles = (imagefile1, imagefile2)
+        self.diff = ImageComparater.EQUAL_DIFF_SCORE
+        self.sizes = None
+        self.infos = None
+
+    def file_sizes(self):
+        if self.sizes is None:
+            self.sizes = tuple(os.path.getsize(file) for file in self.imagefiles)
+        return self.sizes
+
+    def image_infos(self):
+        if self.infos is None:
+            self.infos = tuple(self.cascade.image_info(file) for file in self.imagefiles)
+        return self.infos
+
+class CompareStage(object):
+    """
+    One stage of ImageCascadeComparater, evaluate returns ACCEPT, REJECT or PASS to the next stage
+    """
+    ACCEPT = 1
+    REJECT = -1
+    PASS = 0
+    name = 'stage'
+    reject_code = FileCompareResult.CODE_ERROR
+    reject_reason = ''
+
+    def evaluate(self, pair: ComparePair):
+        return CompareStage.PASS
+
+class FilenameStage(CompareStage):
+    name = 'filename'
+    reject_reason = 'filename not match'
+
+    def evaluate(self, pair: ComparePair):
+        if os.path.basename(pair.imagefiles[0]) == os.path.basename(pair.imagefiles[1]):
+            return CompareStage.PASS
+        return CompareStage.REJECT
+
+class FileSizeStage(CompareStage):
+    """
+    Reject pairs whose file sizes differ more than max_ratio times, None to never reject
+    """
+    name = 'file size'
+    reject_reason = 'file size not match'
+
+    def __init__(self, max_ratio = None):
+        self.max_ratio = max_ratio
+
+    def evaluate(self, pair: ComparePair):
+        size1, size2 = pair.file_sizes()
+        if not self.max_ratio is None and max(size1, size2) > self.max_ratio * max(min(size1, size2), 1):
+            return CompareStage.REJECT
+        return CompareStage.PASS
+
+class HeaderStage(CompareStage):
+    name = 'header'
+    reject_code = FileCompareResult.CODE_WARN
+    reject_reason = 'simple image info not match'
+
+    def evaluate(self, pair: ComparePair):
+        imginfo1, imginfo2 = pair.image_infos()
+        if not imginfo1.type == imginfo2.type or not imginfo1.width == imginfo2.width or not imginfo1.height == imginfo2.height:
+            return CompareStage.REJECT
+        return CompareStage.PASS
+
+class NinePatchStage(CompareStage):
+    """
+    Reject compiled 9-patch pairs whose stretch regions or padding differ, the pixels alone
+    don't tell how they are laid out
+    """
+    name = 'nine patch'
+    reject_reason = 'nine patch chunk not match'
+
+    def evaluate(self, pair: ComparePair):
+        if not all(file_extension(file) == NINE_PATCH_EXTENSION for file in pair.imagefiles):
+            return CompareStage.PASS
+        patch1, patch2 = [PyImgDecoder.read_nine_patch(file) for file in pair.imagefiles]
+        if patch1 is None or patch2 is None or patch1 == patch2:
+            return CompareStage.PASS
+        return CompareStage.REJECT
+
+class ContentDigestCache(object):
+    """
+    Streamed digest of file bytes, xxhash when it is installed otherwise blake2b,
+    cached per path and invalidated when the file size or mtime changes.
+    Digests are also kept across runs when a ComparisonStore is given.
+    """
+    def __init__(self, chunk_size = 1024 * 1024, store: ComparisonStore = None):
+        self.chunk_size = chunk_size
+        self.store = store
+        # path -> (size, mtime, digest)
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def new_digest(self):
+        if xxhash is None:
+            return hashlib.blake2b(digest_size=16)
+        return xxhash.xxh3_128() if hasattr(xxhash, 'xxh3_128') else xxhash.xxh64()
+
+    def compute_digest(self, filepath):
+        digest = self.new_digest()
+        kind = 'digest.{}'.format(digest.name)
+        if not self.store is None:
+            value = self.store.get_file(filepath, kind)
+            if not value is None:
+                return value
+        with io.open(filepath, 'rb') as input:
+            for chunk in iter(lambda: input.read(self.chunk_size), b''):
+                digest.update(chunk)
+        value = digest.hexdigest()
+        if not self.store is None:
+            self.store.put_file(filepath, kind, value)
+        return value
+
+    def digest(self, filepath):
+        stat = os.stat(filepath)
+        entry = self.entries.get(filepath)
+        if not entry is None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        self.entries[filepath] = (stat.st_size, stat.st_mtime_ns, self.compute_digest(filepath))
+        return self.entries[filepath][2]
+
+    def equal(self, filepath1, filepath2) -> bool:
+        """
+        Return True if both files have the same bytes, digests are only computed for files of equal size
+        """
+        if not os.path.getsize(filepath1) == os.path.getsize(filepath2):
+            return False
+        return self.digest(filepath1) == self.digest(filepath2)
+
+default_digest_cache = ContentDigestCache()
+
+def file_digest(filepath):
+    return default_digest_cache.digest(filepath)
+
+class ContentHashStage(CompareStage):
+    """
+    Accept byte identical files, digests are only computed for pairs of equal file size
+    """
+    name = 'content hash'
+
+    def __init__(self, digest_cache: ContentDigestCache = None):
+        if digest_cache is None:
+            digest_cache = default_digest_cache
+        self.digest_cache = digest_cache
+
+    def evaluate(self, pair: ComparePair):
+        size1, size2 = pair.file_sizes()
+        if size1 == size2 and self.digest_cache.digest(pair.imagefiles[0]) == self.digest_cache.digest(pair.imagefiles[1]):
+            return CompareStage.ACCEPT
+        return CompareStage.PASS
+
+class PerceptualHashStage(CompareStage):
+    """
+    Reject pairs whose perceptual hashes are more than radius bits apart,
+    accept pairs within accept_radius bits, None to never accept
+    """
+    name = 'perceptual hash'
+    reject_reason = 'perceptual hash not match'
+
+    def __init__(self, radius = 20, accept_radius = None, method = 'dhash'):
+        self.radius = radius
+        self.accept_radius = accept_radius
+        self.method = method
+        self.hashes = dict()
+
+    def hash(self, filepath):
+        if not filepath in self.hashes:
+            from PyImgHashIndex import image_hash
+            self.hashes[filepath] = image_hash(filepath, self.method)
+        return self.hashes[filepath]
+
+    def evaluate(self, pair: ComparePair):
+        from PyImgHashIndex import hamming_distance
+        distance = hamming_distance(self.hash(pair.imagefiles[0]), self.hash(pair.imagefiles[1]))
+        if distance > self.radius:
+            return CompareStage.REJECT
+        if not self.accept_radius is None and distance <= self.accept_radius:
+            return CompareStage.ACCEPT
+        return CompareStage.PASS
+
+class SSIMStage(CompareStage):
+    """
+    Accept pairs whose SSIM diff is at most max_diff, reject the others
+    """
+    name = 'ssim'
+    reject_reason = 'ssim not match'
+
+    def __init__(self, max_diff = 0.1, comparater = None):
+        self.max_diff = max_diff
+        self.comparater = comparater
+
+    def evaluate(self, pair: ComparePair):
+        if self.comparater is None:
+            from PyProject01 import ImageSSIMComparater
+            self.comparater = ImageSSIMComparater()
+        diff = self.comparater.compare_image(pair.imagefiles[0], pair.imagefiles[1])
+        if diff < 0 or diff > self.max_diff:
+            return CompareStage.REJECT
+        pair.diff = diff
+        return CompareStage.ACCEPT
+
+class StageStats(object):
+    def __init__(self):
+        self.count = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.seconds = 0.0
+
+class ImageCascadeComparater(ImageComparater):
+    """
+    Run stages from cheapest to most expensive, the first stage that accepts or rejects decides
+    the result, pairs passed by every stage are accepted. Counters and timings are kept per stage.
+    Args:
+        stages (list): CompareStage list, default filename, file size, header, nine patch
+        backend (MetadataBackend): backend of image info used by stages and results
+    """
+    def __init__(self, stages = None, backend: MetadataBackend = None):
+        if stages is None:
+            stages = [FilenameStage(), FileSizeStage(), HeaderStage(), NinePatchStage()]
+        self.stages = stages
+        self.backend = backend
+        self.stats = [StageStats() for stage in stages]
+        # path -> ImageInfo, the header of each left and right image is read once
+        self.infos = dict()
+
+    def image_info(self, imagefile) -> ImageInfo:
+        info = self.infos.get(imagefile)
+        if info is None:
+            info = self.infos[imagefile] = load_image_info(imagefile, self.backend)
+        return info
+
+    def calculate_diff(self, imagefile1, imagefile2):
+        pair = ComparePair(self, imagefile1, imagefile2)
+        for stage, stats in zip(self.stages, self.stats):
+            start = time.perf_counter()
+            verdict = stage.evaluate(pair)
+            stats.seconds += time.perf_counter() - start
+            stats.count += 1
+            if CompareStage.REJECT == verdict:
+                stats.rejected += 1
+                return ImageCompareResult(imagefile1, imagefile2, ImageComparater.IGNORE_DIFF_SCORE, self.image_info(imagefile1), stage.reject_code, stage.reject_reason)
+            if CompareStage.ACCEPT == verdict:
+                stats.accepted += 1
+                break
+        return ImageCompareResult(imagefile1, imagefile2, pair.diff, self.image_info(imagefile1))
+
+    def report(self):
+        lines = ['{:<16}{:>10}{:>10}{:>10}{:>12}'.format('stage', 'count', 'accept', 'reject', 'seconds')]
+        for stage, stats in zip(self.stages, self.stats):
+            lines.append('{:<16}{:>10d}{:>10d}{:>10d}{:>12.3f}'.format(stage.name, stats.count, stats.accepted, stats.rejected, stats.seconds))
+        return '\n'.join(lines)
+
 class ImageFileIterator(object):
-    def __init__(self, folders):
+    def __init__(self, folders, manifest: FileManifest = None):
         for folder in folders:
             if not os.path.isdir(folder):
                 raise ValueError('Invalid input folder {} when init'.format(folder))
         self.folders = folders
+        self.manifest = manifest
 
     def is_imagefile(self, imagepath):
         if not os.path.isfile(imagepath):
             return False
-        split = imagepath.split('.')
-        if 'png' == split[len(split) - 1] or 'jpg' == split[len(split) - 1]:
-            return True
-        return False
+        return is_image_extension(imagepath)
 
     def process(self, file):
         pass
@@ -110,44 +466,128 @@ class ImageFileIterator(object):
     def iterator(self, folder):
         if not os.path.isdir(folder):
             raise ValueError('Invalid input folder {} when iterator'.format(folder))
-        for file in os.listdir(folder):
-            file = os.path.join(folder, file)
-            if os.path.isdir(file):
-                self.iterator(file)
-            elif self.is_imagefile(file):
-                self.process(file)
+        for entry in scan_folder(folder):
+            self.process(entry.path)
 
     def start(self):
+        # a shared manifest of the folders saves walking them again
+        if not self.manifest is None:
+            for file in self.manifest.paths():
+                self.process(file)
+            return
         for folder in self.folders:
             self.iterator(folder)
 
+class ImageInfoIndex(ImageFileIterator):
+    """
+    One time index of image folders, answer simple compare queries by hash lookup
+    instead of re-walking the folders and re-opening every image per query
+    """
+    def __init__(self, folders, backend: MetadataBackend = None, manifest: FileManifest = None):
+        super().__init__(folders, manifest)
+        self.backend = backend
+        self.image_count = 0
+        self.first_image = None
+        # (filename, type, width, height) -> [ImageInfo], in folder walk order
+        self.name_dict = dict()
+        # (type, width, height) -> [ImageInfo], in folder walk order
+        self.info_dict = dict()
+        # [ImageInfo] in folder walk order
+        self.image_list = []
+
+    def process(self, file):
+        self.add(load_image_info(file, self.backend))
+
+    def add(self, imginfo: ImageInfo):
+        file = imginfo.path
+        self.image_list.append(imginfo)
+        if self.first_image is None:
+            self.first_image = imginfo
+        self.image_count += 1
+        name_key = (os.path.basename(file), imginfo.type, imginfo.width, imginfo.height)
+        self.name_dict.setdefault(name_key, []).append(imginfo)
+        info_key = (imginfo.type, imginfo.width, imginfo.height)
+        self.info_dict.setdefault(info_key, []).append(imginfo)
+
+    def lookup(self, imagefile):
+        """
+        Return the same results ImageSimpleComparater would give against every indexed image
+        Returns:
+            tuple: (imginfo, equal_list, similar_list, warn_count), similar_list only holds
+            images whose simple image info matches but filename not
+        """
+        imginfo = load_image_info(imagefile, self.backend)
+        filename = os.path.basename(imagefile)
+        equal_list = self.name_dict.get((filename, imginfo.type, imginfo.width, imginfo.height), [])
+        info_list = self.info_dict.get((imginfo.type, imginfo.width, imginfo.height), [])
+        similar_list = [info for info in info_list if not os.path.basename(info.path) == filename]
+        warn_count = self.image_count - len(info_list)
+        return (imginfo, equal_list, similar_list, warn_count)
+
+    def subset(self, keep):
+        """
+        Return an index of the indexed images keep(imginfo) is true for, no metadata is loaded again
+        """
+        index = ImageInfoIndex(self.folders, self.backend)
+        for imginfo in self.image_list:
+            if keep(imginfo):
+                index.add(imginfo)
+        return index
+
 class ImageFileCompareTask(ImageFileIterator):
-    def __init__(self, imagefile, folders):
-        super().__init__(folders)
+    def __init__(self, imagefile, folders, index: ImageInfoIndex = None, backend: MetadataBackend = None, comparater: ImageComparater = None, manifest: FileManifest = None):
+        super().__init__(folders, manifest)
         self.imagefile = imagefile
-        self.comparater = ImageSimpleComparater()
+        self.index = index
+        if comparater is None:
+            comparater = ImageSimpleComparater(backend)
+        self.comparater = comparater
         self.equal_list = []
         self.similar_list = []
         self.warn_list = []
         self.error_list = []
+        # only the first warn and error result is ever reported, the rest are just counted
+        self.warn_collector = TopKCollector(1)
+        self.error_collector = TopKCollector(1)
+        self.warn_count = 0
+        self.error_count = 0
 
     def insert_result(self, result: ImageCompareResult):
         if FileCompareResult.CODE_SUCCESS == result.code:
             self.equal_list.append(result)
         elif FileCompareResult.CODE_WARN == result.code:
-            self.warn_list.append(result)
+            self.warn_count += 1
+            self.warn_collector.add(result)
         elif FileCompareResult.CODE_ERROR == result.code:
-            self.error_list.append(result)
+            self.error_count += 1
+            self.error_collector.add(result)
 
     def process(self, imagefile):
         result = self.comparater.calculate_diff(self.imagefile, imagefile)
         self.insert_result(result)
 
+    def lookup_index(self):
+        imginfo, equal_list, similar_list, warn_count = self.index.lookup(self.imagefile)
+        for info in equal_list:
+            self.insert_result(ImageCompareResult(self.imagefile, info.path, ImageComparater.EQUAL_DIFF_SCORE, imginfo))
+        # only the first error or warn result is ever reported, skip building the rest
+        if not len(similar_list) == 0:
+            self.insert_result(ImageCompareResult(self.imagefile, similar_list[0].path, ImageComparater.IGNORE_DIFF_SCORE, imginfo, FileCompareResult.CODE_ERROR, 'filename not match'))
+        elif len(equal_list) == 0 and not warn_count == 0:
+            self.insert_result(ImageCompareResult(self.imagefile, self.index.first_image.path, ImageComparater.IGNORE_DIFF_SCORE, imginfo, FileCompareResult.CODE_WARN, 'simple image info not match'))
+        self.warn_count = warn_count
+        self.error_count = len(similar_list)
+
     def start(self):
-        super().start()
+        if self.index is None:
+            super().start()
+        else:
+            self.lookup_index()
+        self.warn_list = self.warn_collector.results()
+        self.error_list = self.error_collector.results()
         len_equal = len(self.equal_list)
-        len_error = len(self.error_list)
-        len_warn = len(self.warn_list)
+        len_error = self.error_count
+        len_warn = self.warn_count
         print('{}: equal {:d}, warn {:d}, error {:d}'.format(self.imagefile, len_equal, len_warn, len_error))
         if not len_equal == 0:
             self.warn_list.clear
@@ -167,6 +607,9 @@ class ResultPrinter(object):
     def print(self, compare_task: ImageFileCompareTask):
         pass
 
+    def finish_print(self):
+        pass
+
 class ExcelPrinter(ResultPrinter):
     EQUAL_SHEET_NAME = 'equal'
     SIMILAR_SHEET_NAME = 'similar'
@@ -187,7 +630,13 @@ class ExcelPrinter(ResultPrinter):
         wbk.save(filepath)
         return load_workbook(filepath)
 
-    def __init__(self, filepath, default_sheet_name = EQUAL_SHEET_NAME):
+    def __init__(self, filepath, default_sheet_name = EQUAL_SHEET_NAME, checkpoint = 0):
+        """
+        Args:
+            filepath: excel file path
+            default_sheet_name: title of the active sheet
+            checkpoint: save every checkpoint printed tasks, 0 to only save in finish_print
+        """
         self.filepath = filepath
         self.xlsxfile = self.openxlsx(filepath)
         ws = self.xlsxfile.active
@@ -196,16 +645,27 @@ class ExcelPrinter(ResultPrinter):
         self.sheet_dict = dict()
         self.sheet_dict[default_sheet_name] = 0
         self.fill = PatternFill(patternType='solid', fill_type='solid', fgColor=Color('C4C4C4'))
-
-    def finish_print(self):
+        self.checkpoint = checkpoint
+        self.print_count = 0
+        # sheet title -> {column letter: width}, kept up to date as rows are appended
+        self.dims_dict = dict()
         for ws in self.xlsxfile.worksheets:
-	        #format column width
-            dims = {}
+            dims = self.dims_dict.setdefault(ws.title, {})
             for row in ws.rows:
                 for cell in row:
                     if cell.value:
                         dims[cell.column_letter] = max(dims.get(cell.column_letter, 0), len(str(cell.value)))
-            for col, value in dims.items():
+
+    def track_width(self, sheet_name, column, value):
+        if value:
+            dims = self.dims_dict.setdefault(sheet_name, {})
+            letter = get_column_letter(column)
+            dims[letter] = max(dims.get(letter, 0), len(str(value)))
+
+    def finish_print(self):
+        for ws in self.xlsxfile.worksheets:
+	        #format column width
+            for col, value in self.dims_dict.get(ws.title, {}).items():
                 ws.column_dimensions[col].width = value
         self.xlsxfile.save(self.filepath)
 
@@ -214,13 +674,17 @@ class ExcelPrinter(ResultPrinter):
             self.xlsxfile.create_sheet(sheet_name)
         ws = self.xlsxfile[sheet_name]
         for result in results_list:
-            ws.append(result.iterator())
+            row = result.iterator()
+            ws.append(row)
+            for column, value in enumerate(row, 1):
+                self.track_width(sheet_name, column, value)
             if not result.correct():
                 self.sheet_dict[sheet_name] = self.sheet_dict.get(sheet_name, 0) + 1
                 for row in ws.iter_rows(min_row=ws.max_row):
                     for cell in row:
                         cell.fill = self.fill
                 ws.cell(row = 1, column = 8, value = int(self.sheet_dict[sheet_name]))
+                self.track_width(sheet_name, 8, self.sheet_dict[sheet_name])
 
     def print(self, compare_task: ImageFileCompareTask):
         equal_list = compare_task.equal_list
@@ -244,19 +708,75 @@ class ExcelPrinter(ResultPrinter):
         else:
             #no result
             print('{} no record !!!'.format(compare_task.imagefile))
-        self.finish_print()
+        self.print_count += 1
+        if self.checkpoint > 0 and 0 == self.print_count % self.checkpoint:
+            self.finish_print()
 
 class ImageFolderCompareTask(ImageFileIterator):
-    def __init__(self, folders1, folders2, printer: ResultPrinter):
+    """
+    Compare every image of folders1 against the images of folders2
+    Args:
+        density_aware (bool): only compare images whose folders have matching density qualifiers,
+        e.g. drawable-xhdpi against xhdpi, folders without a density qualifier match any
+    """
+    def __init__(self, folders1, folders2, printer: ResultPrinter, backend: MetadataBackend = None, comparater: ImageComparater = None, density_aware = False):
         super().__init__(folders1)
         self.otherfolders = folders2
         self.printer = printer
+        self.backend = backend
+        self.comparater = comparater
+        self.density_aware = density_aware
+        self.index = None
+        self.other_manifest = None
+        # density -> (FileManifest, ImageInfoIndex) of the other images of a matching density,
+        # filtered from other_manifest and index so each image is only walked and loaded once
+        self.density_groups = dict()
+
+    def build_index(self, manifest: FileManifest = None) -> ImageInfoIndex:
+        # a custom comparater has to see every pair, only the default simple compare can be indexed
+        if not self.comparater is None:
+            return None
+        index = ImageInfoIndex(self.otherfolders, self.backend, manifest)
+        index.start()
+        return index
+
+    def density_group(self, file):
+        """
+        Return (manifest, index) of the other images whose density matches file
+        """
+        density = folder_density(file)
+        group = self.density_groups.get(density)
+        if group is None:
+            manifest = self.other_manifest.subset(lambda entry: densities_match(density, folder_density(entry.path)))
+            index = None
+            if not self.index is None:
+                index = self.index.subset(lambda imginfo: densities_match(density, folder_density(imginfo.path)))
+            group = (manifest, index)
+            self.density_groups[density] = group
+        return group
 
     def start_file_compare_task(self, file) -> ImageFileCompareTask:
-        file_compare_task = ImageFileCompareTask(file, self.otherfolders)
+        manifest, index = self.other_manifest, self.index
+        if self.density_aware:
+            manifest, index = self.density_group(file)
+        file_compare_task = ImageFileCompareTask(file, self.otherfolders, index, self.backend, self.comparater, manifest)
         file_compare_task.start()
         return file_compare_task
 
+    def start(self):
+        self.density_groups = dict()
+        if self.density_aware:
+            self.other_manifest = FileManifest(self.otherfolders)
+            self.index = self.build_index(self.other_manifest)
+        else:
+            self.index = self.build_index()
+            if self.index is None:
+                self.other_manifest = FileManifest(self.otherfolders)
+        super().start()
+        self.printer.finish_print()
+        if not self.comparater is None and not self.comparater.report() is None:
+            print(self.comparater.report())
+
     def process(self, file):
         file_compare_task = self.start_file_compare_task(file)
         # print results
@@ -266,8 +786,15 @@ if __name__ == '__main__':
     ui_folder = ['setting']
     proj_folder = ['future-skin-blue']
     xlsx_filepath = 'setting.xlsx'
-
-    comparater = ImageFolderCompareTask(proj_folder, ui_folder, ExcelPrinter(xlsx_filepath))
-    comparater.start()
+    metadata_backend = 'struct'
+    # print the stage summary of the run
+    profile = False
+    # pstats file of the run, also prints the stage summary, None to disable
+    profile_filepath = None
+
+    from PyImgProfile import profiled
+    with profiled(profile_filepath, enabled = profile or not profile_filepath is None):
+        comparater = ImageFolderCompareTask(proj_folder, ui_folder, ExcelPrinter(xlsx_filepath), get_metadata_backend(metadata_backend))
+        comparater.start()
 
 
@@ -2,6 +2,7 @@ import collections
 import json
 import os
 import io
+import mmap
 import struct
 
 types = collections.OrderedDict()
@@ -11,6 +12,12 @@ ICO = types['ICO'] = 'ICO'
 JPEG = types['JPEG'] = 'JPEG'
 PNG = types['PNG'] = 'PNG'
 TIFF = types['TIFF'] = 'TIFF'
+WEBP = types['WEBP'] = 'WEBP'
+
+FILE_UNKNOWN = "Sorry, don't know how to get size for this file."
+
+class UnknownImageFormat(Exception):
+    pass
 
 image_fields = ['path', 'type', 'file_size', 'width', 'height']
 
@@ -63,11 +70,7 @@ def get_image_metadata(file_path):
     Returns:
         Image: (path, type, file_size, width, height)
     """
-    size = os.path.getsize(file_path)
-
-    # be explicit with open arguments - we need binary mode
-    with io.open(file_path, "rb") as input:
-        return get_image_metadata_from_bytesio(input, size, file_path)
+    return read_image_metadata(file_path)[0]
 
 
 def get_image_metadata_from_bytesio(input, size, file_path=None):
@@ -81,161 +84,272 @@ def get_image_metadata_from_bytesio(input, size, file_path=None):
     Returns:
         Image: (path, type, file_size, width, height)
     """
-    height = -1
-    width = -1
-    data = input.read(26)
+    data = input.read(PREFIX_SIZE)
+    img = get_image_metadata_from_bytes(data, size, file_path)
+    if img is None:
+        # the image size lies beyond the prefix
+        data += input.read()
+        img = get_image_metadata_from_bytes(data, size, file_path)
+    if img is None:
+        raise UnknownImageFormat("Truncated image file")
+    return img
+
+# bytes read by read_image_metadata before falling back to mapping the whole file
+PREFIX_SIZE = 4096
+
+def get_image_metadata_from_bytes(data, size, file_path=None):
+    """
+    Return an `Image` object parsed from image file content in one buffer,
+    JPEG markers are searched with find instead of read byte by byte
+    Args:
+        data (bytes | mmap.mmap): file prefix or the whole file mapped
+        size (int): size of the file in byte
+        file_path (str): path to an image file
+    Returns:
+        Image: (path, type, file_size, width, height), None if data is too
+        short to hold the image size
+    """
+    length = len(data)
     msg = " raised while trying to decode as JPEG."
 
     if (size >= 10) and data[:6] in (b'GIF87a', b'GIF89a'):
         # GIFs
-        imgtype = GIF
-        w, h = struct.unpack("<HH", data[6:10])
-        width = int(w)
-        height = int(h)
-    elif ((size >= 24) and data.startswith(b'\211PNG\r\n\032\n')
+        w, h = struct.unpack_from("<HH", data, 6)
+        return Image(path=file_path, type=GIF, file_size=size, width=int(w), height=int(h))
+    elif ((size >= 24) and data[:8] == b'\211PNG\r\n\032\n'
             and (data[12:16] == b'IHDR')):
         # PNGs
-        imgtype = PNG
-        w, h = struct.unpack(">LL", data[16:24])
-        width = int(w)
-        height = int(h)
-    elif (size >= 16) and data.startswith(b'\211PNG\r\n\032\n'):
+        w, h = struct.unpack_from(">LL", data, 16)
+        return Image(path=file_path, type=PNG, file_size=size, width=int(w), height=int(h))
+    elif (size >= 16) and data[:8] == b'\211PNG\r\n\032\n':
         # older PNGs
-        imgtype = PNG
-        w, h = struct.unpack(">LL", data[8:16])
-        width = int(w)
-        height = int(h)
-    elif (size >= 2) and data.startswith(b'\377\330'):
+        w, h = struct.unpack_from(">LL", data, 8)
+        return Image(path=file_path, type=PNG, file_size=size, width=int(w), height=int(h))
+    elif (size >= 2) and data[:2] == b'\377\330':
         # JPEG
-        imgtype = JPEG
-        input.seek(0)
-        input.read(2)
-        b = input.read(1)
-        try:
-            while (b and ord(b) != 0xDA):
-                while (ord(b) != 0xFF):
-                    b = input.read(1)
-                while (ord(b) == 0xFF):
-                    b = input.read(1)
-                if (ord(b) >= 0xC0 and ord(b) <= 0xC3):
-                    input.read(3)
-                    h, w = struct.unpack(">HH", input.read(4))
-                    break
-                else:
-                    input.read(
-                        int(struct.unpack(">H", input.read(2))[0]) - 2)
-                b = input.read(1)
-            width = int(w)
-            height = int(h)
-        except struct.error:
-            raise UnknownImageFormat("StructError" + msg)
-        except ValueError:
-            raise UnknownImageFormat("ValueError" + msg)
-        except Exception as e:
-            raise UnknownImageFormat(e.__class__.__name__ + msg)
-    elif (size >= 26) and data.startswith(b'BM'):
+        pos = 2
+        while True:
+            pos = data.find(b'\377', pos)
+            if pos < 0:
+                return None if length < size else _raise("EOF" + msg)
+            while pos < length and data[pos] == 0xFF:
+                pos += 1
+            if pos + 3 > length:
+                return None if length < size else _raise("EOF" + msg)
+            marker = data[pos]
+            pos += 1
+            if marker == 0xDA:
+                raise UnknownImageFormat("StartOfScan" + msg)
+            if marker >= 0xC0 and marker <= 0xC3:
+                if pos + 7 > length:
+                    return None
+                h, w = struct.unpack_from(">HH", data, pos + 3)
+                return Image(path=file_path, type=JPEG, file_size=size, width=int(w), height=int(h))
+            if marker == 0x01 or (marker >= 0xD0 and marker <= 0xD9):
+                # standalone markers have no length
+                continue
+            pos += struct.unpack_from(">H", data, pos)[0]
+    elif (size >= 30) and data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        # WebP
+        w, h = get_webp_size(data)
+        return Image(path=file_path, type=WEBP, file_size=size, width=w, height=h)
+    elif (size >= 26) and data[:2] == b'BM':
         # BMP
-        imgtype = 'BMP'
-        headersize = struct.unpack("<I", data[14:18])[0]
+        headersize = struct.unpack_from("<I", data, 14)[0]
         if headersize == 12:
-            w, h = struct.unpack("<HH", data[18:22])
-            width = int(w)
-            height = int(h)
+            w, h = struct.unpack_from("<HH", data, 18)
         elif headersize >= 40:
-            w, h = struct.unpack("<ii", data[18:26])
-            width = int(w)
-            # as h is negative when stored upside down
-            height = abs(int(h))
+            w, h = struct.unpack_from("<ii", data, 18)
         else:
             raise UnknownImageFormat(
                 "Unkown DIB header size:" +
                 str(headersize))
+        # as h is negative when stored upside down
+        return Image(path=file_path, type=BMP, file_size=size, width=int(w), height=abs(int(h)))
     elif (size >= 8) and data[:4] in (b"II\052\000", b"MM\000\052"):
         # Standard TIFF, big- or little-endian
-        # BigTIFF and other different but TIFF-like formats are not
-        # supported currently
-        imgtype = TIFF
-        byteOrder = data[:2]
-        boChar = ">" if byteOrder == "MM" else "<"
-        # maps TIFF type id to size (in bytes)
-        # and python format char for struct
+        boChar = ">" if data[:2] == b"MM" else "<"
         tiffTypes = {
-            1: (1, boChar + "B"),  # BYTE
-            2: (1, boChar + "c"),  # ASCII
-            3: (2, boChar + "H"),  # SHORT
-            4: (4, boChar + "L"),  # LONG
-            5: (8, boChar + "LL"),  # RATIONAL
-            6: (1, boChar + "b"),  # SBYTE
-            7: (1, boChar + "c"),  # UNDEFINED
-            8: (2, boChar + "h"),  # SSHORT
-            9: (4, boChar + "l"),  # SLONG
-            10: (8, boChar + "ll"),  # SRATIONAL
-            11: (4, boChar + "f"),  # FLOAT
-            12: (8, boChar + "d")   # DOUBLE
+            1: boChar + "B", 3: boChar + "H", 4: boChar + "L",
+            6: boChar + "b", 8: boChar + "h", 9: boChar + "l",
         }
-        ifdOffset = struct.unpack(boChar + "L", data[4:8])[0]
-        try:
-            countSize = 2
-            input.seek(ifdOffset)
-            ec = input.read(countSize)
-            ifdEntryCount = struct.unpack(boChar + "H", ec)[0]
-            # 2 bytes: TagId + 2 bytes: type + 4 bytes: count of values + 4
-            # bytes: value offset
-            ifdEntrySize = 12
-            for i in range(ifdEntryCount):
-                entryOffset = ifdOffset + countSize + i * ifdEntrySize
-                input.seek(entryOffset)
-                tag = input.read(2)
-                tag = struct.unpack(boChar + "H", tag)[0]
-                if(tag == 256 or tag == 257):
-                    # if type indicates that value fits into 4 bytes, value
-                    # offset is not an offset but value itself
-                    type = input.read(2)
-                    type = struct.unpack(boChar + "H", type)[0]
-                    if type not in tiffTypes:
-                        raise UnknownImageFormat(
-                            "Unkown TIFF field type:" +
-                            str(type))
-                    typeSize = tiffTypes[type][0]
-                    typeChar = tiffTypes[type][1]
-                    input.seek(entryOffset + 8)
-                    value = input.read(typeSize)
-                    value = int(struct.unpack(typeChar, value)[0])
-                    if tag == 256:
-                        width = value
-                    else:
-                        height = value
-                if width > -1 and height > -1:
-                    break
-        except Exception as e:
-            raise UnknownImageFormat(str(e))
-    elif size >= 2:
-            # see http://en.wikipedia.org/wiki/ICO_(file_format)
-        imgtype = 'ICO'
-        input.seek(0)
-        reserved = input.read(2)
-        if 0 != struct.unpack("<H", reserved)[0]:
-            raise UnknownImageFormat(FILE_UNKNOWN)
-        format = input.read(2)
-        assert 1 == struct.unpack("<H", format)[0]
-        num = input.read(2)
-        num = struct.unpack("<H", num)[0]
+        ifdOffset = struct.unpack_from(boChar + "L", data, 4)[0]
+        if ifdOffset + 2 > length:
+            return None
+        ifdEntryCount = struct.unpack_from(boChar + "H", data, ifdOffset)[0]
+        if ifdOffset + 2 + ifdEntryCount * 12 > length:
+            return None
+        width = -1
+        height = -1
+        for i in range(ifdEntryCount):
+            entryOffset = ifdOffset + 2 + i * 12
+            tag, type = struct.unpack_from(boChar + "HH", data, entryOffset)
+            if tag == 256 or tag == 257:
+                if type not in tiffTypes:
+                    raise UnknownImageFormat(
+                        "Unkown TIFF field type:" +
+                        str(type))
+                value = int(struct.unpack_from(tiffTypes[type], data, entryOffset + 8)[0])
+                if tag == 256:
+                    width = value
+                else:
+                    height = value
+            if width > -1 and height > -1:
+                break
+        return Image(path=file_path, type=TIFF, file_size=size, width=width, height=height)
+    elif (size >= 8) and data[:4] == b'\000\000\001\000':
+        # see http://en.wikipedia.org/wiki/ICO_(file_format)
+        num = struct.unpack_from("<H", data, 4)[0]
         if num > 1:
             import warnings
             warnings.warn("ICO File contains more than one image")
-        # http://msdn.microsoft.com/en-us/library/ms997538.aspx
-        w = input.read(1)
-        h = input.read(1)
-        width = ord(w)
-        height = ord(h)
-    else:
-        raise UnknownImageFormat(FILE_UNKNOWN)
-
-    return Image(path=file_path,
-                 type=imgtype,
-                 file_size=size,
-                 width=width,
-                 height=height)
+        return Image(path=file_path, type=ICO, file_size=size, width=data[6], height=data[7])
+    raise UnknownImageFormat(FILE_UNKNOWN)
+
+def get_webp_size(data):
+    """
+    Return (width, height) from the first chunk of a WebP file, data holds at least 30 bytes
+    see https://developers.google.com/speed/webp/docs/riff_container
+    """
+    chunk = data[12:16]
+    if chunk == b'VP8 ':
+        # lossy, 14 bit sizes after the key frame start code, upper 2 bits are scale
+        if data[23:26] != b'\x9d\x01\x2a':
+            raise UnknownImageFormat("Invalid VP8 start code")
+        w, h = struct.unpack_from("<HH", data, 26)
+        return (w & 0x3fff, h & 0x3fff)
+    elif chunk == b'VP8L':
+        # lossless, signature byte then 14 bit width - 1 and height - 1
+        if data[20] != 0x2f:
+            raise UnknownImageFormat("Invalid VP8L signature")
+        bits = struct.unpack_from("<I", data, 21)[0]
+        return ((bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1)
+    elif chunk == b'VP8X':
+        # extended, 24 bit canvas width - 1 and height - 1 after flags
+        w = data[24] | (data[25] << 8) | (data[26] << 16)
+        h = data[27] | (data[28] << 8) | (data[29] << 16)
+        return (w + 1, h + 1)
+    raise UnknownImageFormat("Unknown WebP chunk:" + repr(chunk))
+
+def get_webp_has_alpha(data):
+    """
+    Return whether a WebP file has an alpha channel from its first chunk, data holds at least 30 bytes
+    """
+    chunk = data[12:16]
+    if chunk == b'VP8L':
+        return bool((data[24] >> 4) & 1)
+    elif chunk == b'VP8X':
+        return bool(data[20] & 0x10)
+    return False
+
+nine_patch_fields = ['xdivs', 'ydivs', 'padding', 'colors']
+
+class NinePatch(collections.namedtuple('NinePatch', nine_patch_fields)):
+    """
+    Stretch regions and padding of a compiled Android 9-patch, padding is (left, right, top, bottom)
+    """
+    pass
+
+def find_png_chunk(data, tag):
+    """
+    Return offset of the data of the first chunk tag found before IDAT in png data, -1 if not found
+    """
+    pos = 8
+    length = len(data)
+    while pos + 8 <= length:
+        chunk_size, chunk_tag = struct.unpack_from(">L4s", data, pos)
+        if chunk_tag == tag:
+            return pos + 8
+        if chunk_tag in (b'IDAT', b'IEND'):
+            break
+        pos += 12 + chunk_size
+    return -1
+
+def get_nine_patch(data):
+    """
+    Return `NinePatch` of the npTc chunk aapt writes into compiled .9.png files, None for png
+    data without it, e.g. source 9-patches that still carry the 1px marker border
+    """
+    pos = find_png_chunk(data, b'npTc')
+    if pos < 0:
+        return None
+    # wasDeserialized, numXDivs, numYDivs, numColors, 2 in memory offsets,
+    # padding left, right, top, bottom, 1 in memory offset, then the int32 arrays
+    numXDivs, numYDivs, numColors = struct.unpack_from(">BBB", data, pos + 1)
+    padding = struct.unpack_from(">llll", data, pos + 12)
+    pos += 32
+    values = struct.unpack_from(">%dl" % (numXDivs + numYDivs + numColors), data, pos)
+    return NinePatch(xdivs=values[:numXDivs],
+                     ydivs=values[numXDivs:numXDivs + numYDivs],
+                     padding=padding,
+                     colors=values[numXDivs + numYDivs:])
+
+def read_nine_patch(file_path):
+    """
+    Return `NinePatch` of a .9.png file, None if it is not compiled by aapt
+    """
+    with io.open(file_path, "rb") as input:
+        if 0 == os.fstat(input.fileno()).st_size:
+            return None
+        with mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:8] != b'\211PNG\r\n\032\n':
+                return None
+            return get_nine_patch(mapped)
+
+def has_nine_patch_border(file_path, data):
+    """
+    Return whether file_path is a source .9.png whose 1px marker border is still in the pixels,
+    aapt moves the border into the npTc chunk when compiling
+    """
+    return file_path.lower().endswith('.9.png') and data[:8] == b'\211PNG\r\n\032\n' and find_png_chunk(data, b'npTc') < 0
+
+def _raise(message):
+    raise UnknownImageFormat(message)
+
+def read_image_metadata(file_path, prefix_size=PREFIX_SIZE):
+    """
+    Return an `Image` object and the bytes it was parsed from. The file is read
+    once up to prefix_size, and only mapped with mmap when the image size lies
+    beyond the prefix.
+    """
+    with io.open(file_path, "rb") as input:
+        size = os.fstat(input.fileno()).st_size
+        data = input.read(prefix_size)
+        img = get_image_metadata_from_bytes(data, size, file_path)
+        if img is None:
+            with mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                img = get_image_metadata_from_bytes(mapped, size, file_path)
+    if img is None:
+        raise UnknownImageFormat("Truncated image file")
+    return (img, data)
+
+def get_images_metadata(file_paths, prefix_size=PREFIX_SIZE, ignore_errors=False):
+    """
+    Yield an `Image` object for each path of file_paths
+    Args:
+        file_paths (iterable): paths to image files
+        prefix_size (int): bytes read per file before falling back to mmap
+        ignore_errors (bool): yield Image with type None for unreadable or
+        unknown files instead of raising
+    """
+    for file_path in file_paths:
+        try:
+            yield read_image_metadata(file_path, prefix_size)[0]
+        except (UnknownImageFormat, OSError, ValueError, struct.error):
+            if not ignore_errors:
+                raise
+            yield Image(path=file_path, type=None, file_size=-1, width=-1, height=-1)
+
+def get_images_metadata_array(file_paths, prefix_size=PREFIX_SIZE):
+    """
+    Return a NumPy structured array of (path, type, file_size, width, height)
+    for file_paths, unknown files have an empty type and -1 fields
+    """
+    import numpy
+    dtype = [('path', object), ('type', 'U4'), ('file_size', 'i8'), ('width', 'i4'), ('height', 'i4')]
+    rows = [(img.path, img.type or '', img.file_size, img.width, img.height)
+            for img in get_images_metadata(file_paths, prefix_size, ignore_errors=True)]
+    return numpy.array(rows, dtype=dtype)
 
 if __name__ == '__main__':
     filepath = '../launcher/launcher/mipmap-mdpi/menu_music_background_select.png'
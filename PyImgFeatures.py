@@ -0,0 +1,267 @@
+import os
+import json
+
+import cv2
+import numpy
+
+from PyImgCache import ImageCache
+from PyTopK import TopKCollector
+from PyProject01 import ImageCacheComparater, RESULT_CODE_ERROR
+
+HIST_BINS = 256
+FEATURE_SIZE = 2 * HIST_BINS
+# indexed rows converted to float64 at a time by FeatureIndex.query
+SCORE_ROWS = 4096
+
+def hist_features(img):
+    """
+    Return float32 feature vector of the 256 bin histogram of the first channel of img, same
+    histogram ImageHistComparater compares. The first half is sqrt(hist / sum(hist)), the dot product
+    of two gives the Bhattacharyya coefficient. The second half is hist minus its mean scaled to unit
+    length, the dot product of two gives the TM_CCOEFF_NORMED match of the histograms.
+    """
+    hist = cv2.calcHist([img], [0], None, [HIST_BINS], [0, HIST_BINS]).ravel().astype(numpy.float64)
+    vector = numpy.zeros(FEATURE_SIZE, numpy.float64)
+    total = hist.sum()
+    if total > 0:
+        vector[:HIST_BINS] = numpy.sqrt(hist / total)
+    centered = hist - hist.mean()
+    norm = numpy.sqrt(numpy.dot(centered, centered))
+    if norm > 0:
+        vector[HIST_BINS:] = centered / norm
+    return vector.astype(numpy.float32)
+
+def feature_scores(vectors, matrix):
+    """
+    Return ImageHistComparater diffs of every vector against every row of matrix in two matrix products,
+    Bhattacharyya distance / 10 + 1 - histogram correlation
+    Args:
+        vectors (numpy.ndarray): (n, FEATURE_SIZE) or (FEATURE_SIZE,) query vectors
+        matrix (numpy.ndarray): (m, FEATURE_SIZE) indexed vectors
+    Returns:
+        numpy.ndarray: (n, m) or (m,) diffs
+    """
+    coefficient = numpy.dot(vectors[..., :HIST_BINS], matrix[:, :HIST_BINS].T)
+    correlation = numpy.dot(vectors[..., HIST_BINS:], matrix[:, HIST_BINS:].T)
+    return numpy.sqrt(numpy.maximum(1.0 - coefficient, 0.0)) / 10 + 1.0 - correlation
+
+class FeatureIndex(object):
+    """
+    Histogram feature vectors of image files in one float32 matrix, saved as a .npy file memory mapped
+    on load, with a json sidecar of the file paths. Vectors are only computed for files new or
+    changed since they were saved. update saves the index, files indexed by add are only written
+    by an explicit save.
+    Args:
+        filepath (str): .npy file of the matrix, None to keep it in memory only
+        cache (ImageCache): decoded image cache
+        mode (str): compare mode the histograms are computed from, one of PyImgCache.COMPARE_MODES
+    """
+    def __init__(self, filepath = None, cache: ImageCache = None, mode = 'full'):
+        if cache is None:
+            cache = ImageCache()
+        self.filepath = filepath
+        self.cache = cache
+        self.mode = mode
+        self.matrix = numpy.zeros((0, FEATURE_SIZE), numpy.float32)
+        # row order: path, [size, mtime, valid]
+        self.paths = []
+        self.entries = []
+        # path -> row
+        self.rows = dict()
+        # rows grown by add, matrix is a view of its first len(paths) rows
+        self.buffer = None
+        # rows added or recomputed since the last save
+        self.dirty = False
+        self.load()
+
+    def meta_filepath(self):
+        return self.filepath + '.json'
+
+    def load(self):
+        if self.filepath is None or not os.path.isfile(self.filepath) or not os.path.isfile(self.meta_filepath()):
+            return
+        with open(self.meta_filepath(), 'r') as input:
+            content = json.load(input)
+        if not content.get('mode', 'full') == self.mode:
+            return
+        matrix = numpy.load(self.filepath, mmap_mode='r')
+        if not len(content.get('paths', [])) == len(matrix) or not matrix.shape[1:] == (FEATURE_SIZE,):
+            return
+        self.matrix = matrix
+        self.paths = content['paths']
+        self.entries = content['entries']
+        self.rows = dict((path, row) for row, path in enumerate(self.paths))
+
+    def save(self):
+        self.dirty = False
+        if self.filepath is None:
+            return
+        # drop the old mapping before the file is written again
+        matrix = numpy.array(self.matrix)
+        self.matrix = None
+        self.buffer = None
+        output = numpy.lib.format.open_memmap(self.filepath, mode='w+', dtype=numpy.float32, shape=matrix.shape)
+        output[:] = matrix
+        output.flush()
+        del output
+        with open(self.meta_filepath(), 'w') as output:
+            json.dump({'mode': self.mode, 'paths': self.paths, 'entries': self.entries}, output)
+        self.matrix = numpy.load(self.filepath, mmap_mode='r')
+
+    def compute_features(self, file):
+        img = self.cache.read_mode(file, self.mode)
+        if img is None:
+            return None
+        return hist_features(img)
+
+    def update(self, files):
+        """
+        Index files in files order
+        """
+        files = list(files)
+        matrix = numpy.zeros((len(files), FEATURE_SIZE), numpy.float32)
+        entries = []
+        for row, file in enumerate(files):
+            stat = os.stat(file)
+            old_row = self.rows.get(file)
+            entry = None if old_row is None else self.entries[old_row]
+            if not entry is None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                matrix[row] = self.matrix[old_row]
+            else:
+                vector = self.compute_features(file)
+                entry = [stat.st_size, stat.st_mtime_ns, not vector is None]
+                if not vector is None:
+                    matrix[row] = vector
+            entries.append(entry)
+        self.matrix = matrix
+        self.buffer = None
+        self.paths = files
+        self.entries = entries
+        self.rows = dict((path, row) for row, path in enumerate(self.paths))
+        self.save()
+
+    def reserve(self, count):
+        """
+        Make matrix a writable view of a buffer of at least count rows, grown by doubling
+        """
+        rows = len(self.paths)
+        if self.buffer is None or len(self.buffer) < count:
+            buffer = numpy.zeros((max(2 * rows, count, 64), FEATURE_SIZE), numpy.float32)
+            buffer[:rows] = self.matrix
+            self.buffer = buffer
+        self.matrix = self.buffer[:rows]
+
+    def is_current(self, row, stat):
+        entry = self.entries[row]
+        return entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+
+    def set_row(self, row, file, stat):
+        vector = self.compute_features(file)
+        self.buffer[row] = 0.0 if vector is None else vector
+        self.entries[row] = [stat.st_size, stat.st_mtime_ns, not vector is None]
+
+    def add(self, files):
+        """
+        Index files not indexed yet after the indexed ones, and compute the rows of indexed files
+        changed since they were indexed again in place. Rows go to a buffer grown by doubling,
+        nothing is written until save.
+        """
+        new_files = []
+        changed = []
+        for file in dict.fromkeys(files):
+            row = self.rows.get(file)
+            if row is None:
+                new_files.append(file)
+                continue
+            stat = os.stat(file)
+            if not self.is_current(row, stat):
+                changed.append((row, file, stat))
+        if not new_files and not changed:
+            return
+        self.reserve(len(self.paths) + len(new_files))
+        for row, file, stat in changed:
+            self.set_row(row, file, stat)
+        for file in new_files:
+            row = len(self.paths)
+            self.rows[file] = row
+            self.paths.append(file)
+            self.entries.append(None)
+            self.set_row(row, file, os.stat(file))
+        self.matrix = self.buffer[:len(self.paths)]
+        self.dirty = True
+
+    def vector(self, imagepath):
+        row = self.rows.get(imagepath)
+        if not row is None:
+            if not self.is_current(row, os.stat(imagepath)):
+                self.add([imagepath])
+            return self.matrix[row] if self.entries[row][2] else None
+        return self.cache.get(imagepath, 'features.' + self.mode, self.compute_features)
+
+    def query(self, imagepath, files = None):
+        """
+        Return [(file, diff)] of imagepath against files, every indexed file when files is None,
+        files not indexed or not decodable get RESULT_CODE_ERROR
+        """
+        if files is None:
+            files = self.paths
+        vector = self.vector(imagepath)
+        rows = [self.rows.get(file) for file in files]
+        valid = [not row is None and self.entries[row][2] for row in rows]
+        if vector is None or not any(valid):
+            return [(file, RESULT_CODE_ERROR) for file in files]
+        selected = numpy.array([row for row, ok in zip(rows, valid) if ok], numpy.intp)
+        vector = numpy.asarray(vector, numpy.float64)
+        # scored in float64 like cv2 does, only SCORE_ROWS candidate rows are converted at a time
+        scores = numpy.empty(len(selected), numpy.float64)
+        for start in range(0, len(selected), SCORE_ROWS):
+            block = self.matrix[selected[start:start + SCORE_ROWS]]
+            scores[start:start + len(block)] = feature_scores(vector, block.astype(numpy.float64))
+        scores = iter(scores.tolist())
+        return [(file, next(scores) if ok else RESULT_CODE_ERROR) for file, ok in zip(files, valid)]
+
+    def query_matrix(self, imagepaths):
+        """
+        Return (len(imagepaths), len(paths)) diffs of imagepaths against every indexed file in one
+        matrix product, rows of images that can't be decoded are NaN
+        """
+        vectors = numpy.zeros((len(imagepaths), FEATURE_SIZE), numpy.float32)
+        invalid = []
+        for i, imagepath in enumerate(imagepaths):
+            vector = self.vector(imagepath)
+            if vector is None:
+                invalid.append(i)
+            else:
+                vectors[i] = vector
+        scores = feature_scores(vectors, self.matrix)
+        scores[invalid, :] = numpy.nan
+        scores[:, [not entry[2] for entry in self.entries]] = numpy.nan
+        return scores
+
+    def __len__(self):
+        return len(self.paths)
+
+class ImageFeatureComparater(ImageCacheComparater):
+    """
+    Same diff as ImageHistComparater, computed from a FeatureIndex, one matrix product per left image
+    instead of one cv2.compareHist and matchTemplate call per pair. Files compared are added to the
+    index, save writes them once the compare is done.
+    """
+    def __init__(self, cache: ImageCache = None, index: FeatureIndex = None):
+        if index is None:
+            index = FeatureIndex(cache = cache)
+        super().__init__(index.cache, mode = index.mode)
+        self.index = index
+
+    def compare_image(self, imagepath1, imagepath2):
+        for file, diff in self.compare_image_list(imagepath1, [imagepath2]):
+            return diff
+        return RESULT_CODE_ERROR
+
+    def compare_image_list(self, imagepath, files, collector: TopKCollector = None):
+        self.index.add(files)
+        return self.index.query(imagepath, files)
+
+    def save(self):
+        if self.index.dirty:
+            self.index.save()
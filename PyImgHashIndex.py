@@ -0,0 +1,144 @@
+import io
+import os
+import json
+
+from PIL import Image
+import imagehash
+
+import PyImgDecoder
+from PyImgStore import ComparisonStore
+
+HASH_METHODS = {
+    'dhash': imagehash.dhash,
+    'phash': imagehash.phash,
+}
+
+def image_hash(imagepath, method = 'dhash'):
+    """
+    Return 64 bit perceptual hash of an image file as int
+    """
+    with open(imagepath, 'rb') as input:
+        data = input.read()
+    with Image.open(io.BytesIO(data)) as img:
+        if img.width > 2 and img.height > 2 and PyImgDecoder.has_nine_patch_border(imagepath, data):
+            img = img.crop((1, 1, img.width - 1, img.height - 1))
+        return int(str(HASH_METHODS[method](img)), 16)
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree over hamming distance of int hashes
+    """
+    def __init__(self):
+        # node: [hash, items, {distance: child node}]
+        self.root = None
+
+    def add(self, hash, item):
+        if self.root is None:
+            self.root = [hash, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(hash, node[0])
+            if 0 == distance:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash, [item], {}]
+                return
+            node = child
+
+    def search(self, hash, radius):
+        """
+        Return [(distance, item)] of every item within radius of hash
+        """
+        results = []
+        if self.root is None:
+            return results
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(hash, node[0])
+            if distance <= radius:
+                results.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+        return results
+
+class ImageHashIndex(object):
+    """
+    Persistent perceptual hash index of image files, used to pick the candidates worth an expensive compare
+    Args:
+        filepath (str): json file the hashes are kept in between runs, None to keep them in memory only
+        method (str): hash method, one of HASH_METHODS
+        radius (int): max hamming distance of a candidate
+        top_k (int): max candidates returned by query
+        store (ComparisonStore): shared persistent cache hashes are also looked up in
+    """
+    def __init__(self, filepath = None, method = 'dhash', radius = 20, top_k = 40, store: ComparisonStore = None):
+        if not method in HASH_METHODS:
+            raise ValueError('Invalid hash method {}, must be one of {}'.format(method, list(HASH_METHODS)))
+        self.filepath = filepath
+        self.method = method
+        self.radius = radius
+        self.top_k = top_k
+        self.store = store
+        # path -> [size, mtime, hash]
+        self.entries = dict()
+        self.files = []
+        self.tree = BKTree()
+        self.load()
+
+    def load(self):
+        if self.filepath is None or not os.path.isfile(self.filepath):
+            return
+        with open(self.filepath, 'r') as input:
+            content = json.load(input)
+        if content.get('method') == self.method:
+            self.entries = content.get('entries', {})
+
+    def save(self):
+        if self.filepath is None:
+            return
+        with open(self.filepath, 'w') as output:
+            json.dump({'method': self.method, 'entries': self.entries}, output)
+
+    def file_hash(self, file):
+        kind = 'hash.{}'.format(self.method)
+        if not self.store is None:
+            value = self.store.get_file(file, kind)
+            if not value is None:
+                return int(value, 16)
+        hash = image_hash(file, self.method)
+        if not self.store is None:
+            self.store.put_file(file, kind, '{:016x}'.format(hash))
+        return hash
+
+    def update(self, files):
+        """
+        Index files, hashes are only computed for files new or changed since they were saved
+        """
+        entries = dict()
+        self.files = list(files)
+        self.tree = BKTree()
+        for order, file in enumerate(self.files):
+            stat = os.stat(file)
+            entry = self.entries.get(file)
+            if entry is None or not entry[0] == stat.st_size or not entry[1] == stat.st_mtime_ns:
+                entry = [stat.st_size, stat.st_mtime_ns, self.file_hash(file)]
+            entries[file] = entry
+            self.tree.add(entry[2], order)
+        self.entries = entries
+        self.save()
+
+    def query(self, imagepath):
+        """
+        Return the top_k indexed files nearest to imagepath within radius, in indexed order
+        """
+        hash = self.entries[imagepath][2] if imagepath in self.entries else image_hash(imagepath, self.method)
+        candidates = sorted(self.tree.search(hash, self.radius))[:self.top_k]
+        return [self.files[order] for order in sorted(order for distance, order in candidates)]
@@ -0,0 +1,58 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from PyImgCache import ImageCache, decode_image
+
+class ImagePrefetcher(object):
+    """
+    Read and decode images on a thread pool ahead of the comparater. File reads and cv2.imdecode
+    release the GIL, so decoding overlaps with comparing. At most depth images are in flight,
+    which caps the memory held by decoded images not consumed yet.
+    Args:
+        workers (int): decode threads
+        depth (int): max images read or decoded ahead of the consumer
+    """
+    def __init__(self, workers = 4, depth = 16):
+        self.workers = workers
+        self.depth = depth
+        self.executor = None
+
+    # thread pools can't be pickled, a process pool worker starts its own
+    def __getstate__(self):
+        return {'workers': self.workers, 'depth': self.depth}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.executor = None
+
+    def iterate(self, paths, cache: ImageCache = None):
+        """
+        Yield (path, image) in paths order, decoded images are also put into cache.
+        Paths already in cache are not decoded again.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers)
+        pending = collections.deque()
+        for path in paths:
+            if not cache is None and cache.has(path, ImageCache.IMAGE):
+                pending.append((path, None))
+            else:
+                pending.append((path, self.executor.submit(decode_image, path)))
+            if len(pending) >= self.depth:
+                yield self.consume(pending.popleft(), cache)
+        while pending:
+            yield self.consume(pending.popleft(), cache)
+
+    def consume(self, item, cache):
+        path, future = item
+        if future is None:
+            return (path, cache.read_image(path))
+        img = future.result()
+        if not cache is None:
+            cache.set(path, ImageCache.IMAGE, img)
+        return (path, img)
+
+    def close(self):
+        if not self.executor is None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,219 @@
+import os
+import sys
+import math
+import time
+import array
+import threading
+import inspect
+import functools
+import contextlib
+
+# method name -> stage of every class of the instrumented modules defining it
+METHOD_STAGES = {
+    'iterator': 'iterate',
+    'calculate_diff': 'compare',
+    'compare_image': 'compare',
+    'compare_image_list': 'compare',
+    'compute_digest': 'digest',
+    'finish_print': 'report',
+}
+# method name -> stage of the classes deriving from a class of the given name
+BASE_METHOD_STAGES = {
+    ('MetadataBackend', 'load'): 'metadata',
+}
+# module function name -> stage
+FUNCTION_STAGES = {
+    'scan_folder': 'walk',
+    'decode_image': 'decode',
+}
+# stage -> position of the file path argument, the file size is counted as bytes read
+BYTES_ARGS = {
+    'decode': 0,
+    'digest': 1,
+}
+# __main__ covers the classes of a module run as a script
+INSTRUMENTED_MODULES = ['PyFileScanner', 'PyImgCache', 'PyImgPrefetch', 'PyImgCmp', 'PyProject01',
+                        'PyImgSSIM', 'PyImgTiles', 'PyImgPyramid', 'PyImgFeatures', 'PyResultStore', 'SkinApkGenerat', '__main__']
+
+# latency histogram buckets per doubling, a percentile is off by at most 2 ** (1 / 8), about 9%
+BUCKETS_PER_OCTAVE = 8
+# bucket 0 holds latencies up to 2 ** MIN_OCTAVE seconds, the last one those over 2 ** MAX_OCTAVE
+MIN_OCTAVE = -30
+MAX_OCTAVE = 12
+BUCKET_COUNT = (MAX_OCTAVE - MIN_OCTAVE) * BUCKETS_PER_OCTAVE + 1
+
+class StageStat(object):
+    """
+    Call count, seconds and bytes of a stage, latencies are counted in a fixed log bucketed
+    histogram so memory stays constant whatever the number of calls
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.min = None
+        self.max = None
+        self.buckets = array.array('q', bytes(8 * BUCKET_COUNT))
+
+    def add(self, seconds, nbytes = 0):
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        if seconds > 0:
+            bucket = int(math.ceil((math.log2(seconds) - MIN_OCTAVE) * BUCKETS_PER_OCTAVE))
+            bucket = min(BUCKET_COUNT - 1, max(0, bucket))
+        else:
+            bucket = 0
+        self.buckets[bucket] += 1
+
+    def percentile(self, point):
+        """
+        Return the nearest rank percentile, the upper bound of its bucket within the observed min and max
+        """
+        if 0 == self.count:
+            return 0.0
+        rank = min(self.count, max(1, int(round(point / 100.0 * self.count))))
+        total = 0
+        for bucket, count in enumerate(self.buckets):
+            total += count
+            if total >= rank:
+                break
+        upper = 2.0 ** (MIN_OCTAVE + bucket / BUCKETS_PER_OCTAVE)
+        return min(self.max, max(self.min, upper))
+
+class Profiler(object):
+    """
+    Counts, cumulative and percentile timings and bytes read per stage of a run. A call nested in a call
+    of the same stage, e.g. compare_image called by calculate_diff, is only counted once.
+    Cheap enough to keep on, two perf_counter calls and a histogram bucket increment per call.
+    Args:
+        profile_filepath (str): pstats file cProfile output is dumped to in stop, None to not run cProfile
+    """
+    def __init__(self, profile_filepath = None):
+        self.profile_filepath = profile_filepath
+        self.stats = dict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profile = None
+        self.patches = []
+        self.start_time = None
+        self.seconds = 0.0
+
+    def record(self, stage, seconds, nbytes = 0):
+        with self.lock:
+            stat = self.stats.get(stage)
+            if stat is None:
+                stat = self.stats[stage] = StageStat()
+            stat.add(seconds, nbytes)
+
+    def wrap(self, function, stage):
+        """
+        Return function recording its calls under stage
+        """
+        bytes_arg = BYTES_ARGS.get(stage)
+        profiler = self
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            active = profiler.local.__dict__.setdefault('active', set())
+            if stage in active:
+                return function(*args, **kwargs)
+            active.add(stage)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                active.discard(stage)
+                nbytes = 0
+                if not bytes_arg is None and len(args) > bytes_arg:
+                    try:
+                        nbytes = os.path.getsize(args[bytes_arg])
+                    except (OSError, TypeError):
+                        pass
+                profiler.record(stage, elapsed, nbytes)
+        wrapper.profile_stage = stage
+        return wrapper
+
+    def patch(self, owner, name, stage):
+        original = getattr(owner, name) if not isinstance(owner, type) else owner.__dict__[name]
+        # generators return before doing their work, they are timed by the methods they call
+        if hasattr(original, 'profile_stage') or isinstance(original, (staticmethod, classmethod)) or inspect.isgeneratorfunction(original):
+            return
+        setattr(owner, name, self.wrap(original, stage))
+        self.patches.append((owner, name, original))
+
+    def instrument(self, modules = None):
+        """
+        Wrap the hot paths of modules, every imported module of INSTRUMENTED_MODULES by default
+        """
+        if modules is None:
+            modules = [sys.modules[name] for name in INSTRUMENTED_MODULES if name in sys.modules]
+        for module in modules:
+            for name, value in list(vars(module).items()):
+                if name in FUNCTION_STAGES and callable(value) and not isinstance(value, type):
+                    self.patch(module, name, FUNCTION_STAGES[name])
+                elif isinstance(value, type) and value.__module__ == module.__name__:
+                    for method, stage in METHOD_STAGES.items():
+                        if method in value.__dict__:
+                            self.patch(value, method, stage)
+                    bases = set(base.__name__ for base in value.__mro__[1:])
+                    for (base, method), stage in BASE_METHOD_STAGES.items():
+                        if base in bases and method in value.__dict__:
+                            self.patch(value, method, stage)
+
+    def uninstrument(self):
+        for owner, name, original in reversed(self.patches):
+            setattr(owner, name, original)
+        self.patches = []
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        if not self.profile_filepath is None:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if not self.profile is None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profile_filepath)
+            self.profile = None
+        if not self.start_time is None:
+            self.seconds += time.perf_counter() - self.start_time
+            self.start_time = None
+
+    def report(self):
+        lines = ['{:<10}{:>10}{:>12}{:>10}{:>10}{:>10}{:>14}'.format('stage', 'count', 'seconds', 'p50 ms', 'p95 ms', 'p99 ms', 'bytes read')]
+        for stage in sorted(self.stats, key=lambda stage: -self.stats[stage].seconds):
+            stat = self.stats[stage]
+            lines.append('{:<10}{:>10d}{:>12.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>14d}'.format(
+                stage, stat.count, stat.seconds, stat.percentile(50) * 1000, stat.percentile(95) * 1000, stat.percentile(99) * 1000, stat.bytes))
+        lines.append('{:<10}{:>10}{:>12.3f}'.format('total', '', self.seconds))
+        if not self.profile_filepath is None:
+            lines.append('cProfile stats: {}'.format(self.profile_filepath))
+        return '\n'.join(lines)
+
+@contextlib.contextmanager
+def profiled(profile_filepath = None, modules = None, verbose = True, enabled = True):
+    """
+    Instrument modules for the with block, print the summary table at the end when verbose.
+    Nothing is instrumented and None is yielded when not enabled.
+    """
+    if not enabled:
+        yield None
+        return
+    profiler = Profiler(profile_filepath)
+    profiler.instrument(modules)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.uninstrument()
+        if verbose:
+            print(profiler.report())
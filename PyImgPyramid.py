@@ -0,0 +1,88 @@
+import cv2
+import numpy
+
+from PyImgCache import ImageCache
+from PyImgPrefetch import ImagePrefetcher
+from PyTopK import TopKCollector
+from PyImgSSIM import ssim_batch, dtype_data_range, SSIM_WIN_SIZE
+from PyProject01 import ImageSSIMComparater, RESULT_CODE_ERROR
+
+PYRAMID_FACTORS = (8, 4, 2)
+
+def pyramid_level(img, factor):
+    """
+    Return img shrunk factor times with area interpolation, read only like cached images
+    """
+    width = max(1, img.shape[1] // factor)
+    height = max(1, img.shape[0] // factor)
+    level = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    if level.ndim < img.ndim:
+        # cv2 drops the channel axis of single channel images
+        level = level.reshape(level.shape + (1,))
+    level.flags.writeable = False
+    return level
+
+class ImagePyramidComparater(ImageSSIMComparater):
+    """
+    Rank candidates with SSIM of downsampled levels from coarsest to finest, only the best of each
+    level are promoted to the next, and only the survivors of the finest level get the full resolution
+    SSIM of ImageSSIMComparater. Levels are computed once per image and kept in the cache.
+    Files dropped on the way aren't returned, the top K stays the same as a full compare as long as
+    it is among the files promoted at every level, raise promote for sets of many near copies.
+    Args:
+        factors (tuple): downsample factors from coarsest to finest
+        promote (int): candidates promoted from the finest level per collector record,
+        doubled at each coarser level
+        batch_size (int): max images stacked into one SSIM pass
+    """
+    def __init__(self, cache: ImageCache = None, prefetcher: ImagePrefetcher = None, factors = PYRAMID_FACTORS, promote = 4, batch_size = 64, mode = 'full'):
+        super().__init__(cache, prefetcher, mode)
+        self.factors = factors
+        self.promote = promote
+        self.batch_size = batch_size
+        # pixels compared at each level, full resolution last
+        self.pixels = dict()
+
+    def read_level(self, imagepath, factor):
+        return self.cache.get(imagepath, 'pyramid.{:d}.{}'.format(factor, self.mode), lambda path: pyramid_level(self.read_image(path), factor))
+
+    def level_scores(self, imagepath, files, factor):
+        """
+        Return [SSIM] of imagepath against files at the level of factor
+        """
+        query = self.read_level(imagepath, factor)
+        data_range = dtype_data_range(query.dtype)
+        query = query.astype(numpy.float64)
+        scores = []
+        for start in range(0, len(files), self.batch_size):
+            batch = files[start:start + self.batch_size]
+            images = numpy.stack([self.read_level(file, factor) for file in batch]).astype(numpy.float64)
+            scores.extend(ssim_batch(query, images, data_range))
+        self.pixels[factor] = self.pixels.get(factor, 0) + query.size * len(files)
+        return scores
+
+    def compare_image_list(self, imagepath, files, collector: TopKCollector = None):
+        img = self.read_image(imagepath)
+        results = []
+        candidates = []
+        for file in self.prefetched(files):
+            other = self.read_image(file)
+            if img is None or other is None or not img.dtype == other.dtype or not img.shape == other.shape:
+                results.append((file, RESULT_CODE_ERROR))
+            else:
+                candidates.append(file)
+        if not collector is None and collector.max_record > 0:
+            for level, factor in enumerate(self.factors):
+                keep = collector.max_record * self.promote * 2 ** (len(self.factors) - 1 - level)
+                if len(candidates) <= keep or min(img.shape[:2]) // factor < SSIM_WIN_SIZE:
+                    continue
+                scores = self.level_scores(imagepath, candidates, factor)
+                # stable, among equal scores the earlier file is kept like the collector does
+                ranked = sorted(range(len(candidates)), key=lambda i: -scores[i])[:keep]
+                candidates = [candidates[i] for i in sorted(ranked)]
+        self.pixels[1] = self.pixels.get(1, 0) + (0 if img is None else img.size * len(candidates))
+        results.extend((file, self.compare_image(imagepath, file)) for file in candidates)
+        return results
+
+    def __str__(self):
+        return 'ImagePyramidComparater: pixels compared per level {}'.format(sorted(self.pixels.items(), reverse=True))
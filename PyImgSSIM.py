@@ -0,0 +1,156 @@
+import numpy
+from scipy.ndimage import uniform_filter
+
+import PyImgDecoder
+from PyImgCache import ImageCache
+from PyProject01 import ImageCacheComparater, RESULT_CODE_ERROR
+
+SSIM_WIN_SIZE = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+# bytes of the float64 image stack of one SSIM pass, the filters need a few times more
+MAX_BATCH_BYTES = 64 * 1024 * 1024
+
+def dtype_data_range(dtype):
+    if numpy.issubdtype(dtype, numpy.integer):
+        info = numpy.iinfo(dtype)
+        return float(info.max) - float(info.min)
+    return 2.0
+
+def ssim_batch(image, images, data_range, win_size = SSIM_WIN_SIZE):
+    """
+    Return mean SSIM of image against every image of the stack images, same as skimage
+    compare_ssim(multichannel=True) with its default uniform window and sample covariance
+    Args:
+        image (numpy.ndarray): float64 array of shape (h, w) or (h, w, c)
+        images (numpy.ndarray): float64 array of shape (n,) + image.shape
+        data_range (float): value range of the image dtype
+    Returns:
+        numpy.ndarray: n SSIM scores
+    """
+    size = (win_size, win_size) + (1,) * (image.ndim - 2)
+    stack_size = (1,) + size
+    cov_norm = win_size * win_size / (win_size * win_size - 1.0)
+    c1 = (SSIM_K1 * data_range) ** 2
+    c2 = (SSIM_K2 * data_range) ** 2
+
+    # statistics of the query image are filtered once and broadcast over the stack
+    ux = uniform_filter(image, size=size)
+    vx = cov_norm * (uniform_filter(image * image, size=size) - ux * ux)
+    uy = uniform_filter(images, size=stack_size)
+    vy = cov_norm * (uniform_filter(images * images, size=stack_size) - uy * uy)
+    vxy = cov_norm * (uniform_filter(images * image, size=stack_size) - ux * uy)
+
+    s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+    pad = (win_size - 1) // 2
+    s = s[:, pad:-pad, pad:-pad]
+    return s.reshape(len(images), -1).mean(axis=1)
+
+def batch_length(image, batch_size, max_batch_bytes = MAX_BATCH_BYTES):
+    """
+    Return how many images like image are stacked into one SSIM pass, at most batch_size
+    and at least one, the float64 stack fits in max_batch_bytes
+    """
+    return max(1, min(batch_size, max_batch_bytes // max(1, image.size * 8)))
+
+def header_key(imagepath):
+    """
+    Return (width, height) from the image header, None if the header can't be parsed.
+    Source 9-patches are 2px smaller like decode_image returns them without their marker border.
+    """
+    try:
+        img, data = PyImgDecoder.read_image_metadata(imagepath)
+    except Exception:
+        return None
+    if img.width > 2 and img.height > 2 and PyImgDecoder.has_nine_patch_border(imagepath, data):
+        return (img.width - 2, img.height - 2)
+    return (img.width, img.height)
+
+class BatchSSIMEngine(object):
+    """
+    Bucket images by header dimensions, then by decoded (dtype, shape), and compute SSIM of
+    one query against a whole bucket in one vectorized pass. Buckets of other dimensions are
+    skipped without being decoded.
+    Args:
+        cache (ImageCache): decoded image cache
+        batch_size (int): max images stacked into one pass
+        mode (str): compare mode, one of PyImgCache.COMPARE_MODES
+        max_batch_bytes (int): max bytes of the float64 images stacked into one pass
+    """
+    def __init__(self, cache: ImageCache = None, batch_size = 64, mode = 'full', max_batch_bytes = MAX_BATCH_BYTES):
+        if cache is None:
+            cache = ImageCache()
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.mode = mode
+        # file -> header key
+        self.file_keys = dict()
+        # header key -> [file]
+        self.header_buckets = dict()
+        # header key -> {(dtype, shape): [file]}
+        self.groups = dict()
+
+    def add_files(self, files):
+        for file in files:
+            if file in self.file_keys:
+                continue
+            key = header_key(file)
+            self.file_keys[file] = key
+            self.header_buckets.setdefault(key, []).append(file)
+            self.groups.pop(key, None)
+
+    def get_groups(self, key):
+        groups = self.groups.get(key)
+        if groups is None:
+            groups = dict()
+            for file in self.header_buckets.get(key, []):
+                img = self.cache.read_mode(file, self.mode)
+                if not img is None:
+                    groups.setdefault((img.dtype.str, img.shape), []).append(file)
+            self.groups[key] = groups
+        return groups
+
+    def query(self, imagepath, files = None):
+        """
+        Return {file: SSIM} of imagepath against indexed files of the same dtype and shape,
+        only files in files are compared when it is given
+        """
+        img = self.cache.read_mode(imagepath, self.mode)
+        scores = dict()
+        if img is None or img.ndim < 2 or min(img.shape[:2]) < SSIM_WIN_SIZE:
+            return scores
+        selected = None if files is None else set(files)
+        keys = [(img.shape[1], img.shape[0])]
+        if None in self.header_buckets:
+            keys.append(None)
+        image = img.astype(numpy.float64)
+        data_range = dtype_data_range(img.dtype)
+        length = batch_length(img, self.batch_size, self.max_batch_bytes)
+        for key in keys:
+            group = self.get_groups(key).get((img.dtype.str, img.shape), [])
+            if not selected is None:
+                group = [file for file in group if file in selected]
+            for start in range(0, len(group), length):
+                batch = group[start:start + length]
+                images = numpy.stack([self.cache.read_mode(file, self.mode) for file in batch]).astype(numpy.float64)
+                for file, score in zip(batch, ssim_batch(image, images, data_range)):
+                    scores[file] = float(score)
+        return scores
+
+class ImageBatchSSIMComparater(ImageCacheComparater):
+
+    def __init__(self, cache: ImageCache = None, batch_size = 64, mode = 'full', max_batch_bytes = MAX_BATCH_BYTES):
+        super().__init__(cache, mode = mode)
+        self.engine = BatchSSIMEngine(self.cache, batch_size, mode, max_batch_bytes)
+
+    def compare_image(self, imagepath1, imagepath2):
+        for file, diff in self.compare_image_list(imagepath1, [imagepath2]):
+            return diff
+        return RESULT_CODE_ERROR
+
+    def compare_image_list(self, imagepath, files, collector = None):
+        self.engine.add_files(files)
+        scores = self.engine.query(imagepath, files)
+        # files of another dtype or shape can't be compared, like ImageSSIMComparater they get RESULT_CODE_ERROR
+        return [(file, 1.0 - scores[file]) if file in scores else (file, RESULT_CODE_ERROR) for file in files]
@@ -0,0 +1,88 @@
+import os
+import sqlite3
+
+class ComparisonStore(object):
+    """
+    Persistent cache across runs of per file values (image info, content digest, perceptual hash)
+    and pairwise comparater scores, in a SQLite file. Entries are keyed by (path, size, mtime, version),
+    a changed file or a new comparater version just misses and is overwritten.
+    Args:
+        filepath (str): SQLite database file, created if missing
+        commit_interval (int): puts between two commits
+    """
+    def __init__(self, filepath, commit_interval = 1000):
+        self.filepath = filepath
+        self.commit_interval = commit_interval
+        self.open()
+
+    def open(self):
+        self.connection = sqlite3.connect(self.filepath, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                'path TEXT, kind TEXT, size INTEGER, mtime INTEGER, version INTEGER, value TEXT, '
+                                'PRIMARY KEY (path, kind))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                                'left TEXT, right TEXT, comparater TEXT, version INTEGER, '
+                                'left_size INTEGER, left_mtime INTEGER, right_size INTEGER, right_mtime INTEGER, score REAL, '
+                                'PRIMARY KEY (left, right, comparater))')
+        self.pending = 0
+
+    # sqlite connections can't be pickled, a process pool worker opens its own
+    def __getstate__(self):
+        return {'filepath': self.filepath, 'commit_interval': self.commit_interval}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def file_key(self, path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    def get_file(self, path, kind, version = 1):
+        """
+        Return value of kind stored for path, None if missing or stale
+        """
+        abspath, size, mtime = self.file_key(path)
+        row = self.connection.execute('SELECT size, mtime, version, value FROM files WHERE path=? AND kind=?', (abspath, kind)).fetchone()
+        if row is None or not row[:3] == (size, mtime, version):
+            return None
+        return row[3]
+
+    def put_file(self, path, kind, value, version = 1):
+        abspath, size, mtime = self.file_key(path)
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', (abspath, kind, size, mtime, version, value))
+        self.after_put()
+
+    def get_pair(self, leftpath, rightpath, comparater, version = 1):
+        """
+        Return score of comparater stored for the pair, None if missing or stale
+        """
+        left, left_size, left_mtime = self.file_key(leftpath)
+        right, right_size, right_mtime = self.file_key(rightpath)
+        row = self.connection.execute('SELECT version, left_size, left_mtime, right_size, right_mtime, score FROM pairs '
+                                      'WHERE left=? AND right=? AND comparater=?', (left, right, comparater)).fetchone()
+        if row is None or not row[:5] == (version, left_size, left_mtime, right_size, right_mtime):
+            return None
+        return row[5]
+
+    def put_pair(self, leftpath, rightpath, comparater, score, version = 1):
+        left, left_size, left_mtime = self.file_key(leftpath)
+        right, right_size, right_mtime = self.file_key(rightpath)
+        self.connection.execute('INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (left, right, comparater, version, left_size, left_mtime, right_size, right_mtime, score))
+        self.after_put()
+
+    def after_put(self):
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
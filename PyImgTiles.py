@@ -0,0 +1,164 @@
+import collections
+
+import numpy
+from scipy.ndimage import uniform_filter
+
+from PyImgCache import ImageCache
+from PyImgPrefetch import ImagePrefetcher
+from PyTopK import TopKCollector
+from PyImgSSIM import SSIM_WIN_SIZE, SSIM_K1, SSIM_K2, dtype_data_range
+from PyProject01 import ImageCacheComparater, RESULT_CODE_ERROR
+
+tile_fields = ['diff', 'complete', 'diff_map']
+
+class TileDiff(collections.namedtuple('TileDiff', tile_fields)):
+    """
+    Result of tile_ssim, diff is 1 - SSIM when complete, otherwise a lower bound of it that
+    already exceeds the limit. diff_map holds 1 - SSIM per tile, NaN for tiles never compared.
+    """
+    pass
+
+def ssim_map(image1, image2, data_range, win_size = SSIM_WIN_SIZE):
+    """
+    Return SSIM map of two float64 arrays of the same shape, pixels closer than win_size // 2
+    to the border are cropped, the rest are the same values skimage compare_ssim averages
+    """
+    size = (win_size, win_size) + (1,) * (image1.ndim - 2)
+    cov_norm = win_size * win_size / (win_size * win_size - 1.0)
+    c1 = (SSIM_K1 * data_range) ** 2
+    c2 = (SSIM_K2 * data_range) ** 2
+    ux = uniform_filter(image1, size=size)
+    uy = uniform_filter(image2, size=size)
+    vx = cov_norm * (uniform_filter(image1 * image1, size=size) - ux * ux)
+    vy = cov_norm * (uniform_filter(image2 * image2, size=size) - uy * uy)
+    vxy = cov_norm * (uniform_filter(image1 * image2, size=size) - ux * uy)
+    s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+    pad = (win_size - 1) // 2
+    return s[pad:-pad, pad:-pad]
+
+def coarse_to_fine_order(rows, cols):
+    """
+    Return (row, col) of every tile, tiles of a stride 4 grid first, then stride 2, then the rest,
+    so the first tiles compared are spread over the whole image
+    """
+    order = []
+    seen = set()
+    for stride in (4, 2, 1):
+        for row in range(0, rows, stride):
+            for col in range(0, cols, stride):
+                if not (row, col) in seen:
+                    seen.add((row, col))
+                    order.append((row, col))
+    return order
+
+def tile_ssim(image1, image2, tile_size = 128, limit = None, win_size = SSIM_WIN_SIZE):
+    """
+    SSIM diff of two images of the same dtype and shape computed tile by tile. Each tile is filtered
+    with a win_size // 2 margin, so the tile maps partition the full SSIM map and a complete
+    run gives the same diff as the full image compare.
+    The diff of the tiles compared so far over the whole image is a lower bound of the final diff,
+    the compare stops as soon as it exceeds limit.
+    Args:
+        image1 (numpy.ndarray): image of shape (h, w) or (h, w, c)
+        image2 (numpy.ndarray): image of the same dtype and shape
+        tile_size (int): tile width and height in pixel
+        limit (float): diff above which the compare stops, None to always finish
+    Returns:
+        TileDiff: (diff, complete, diff_map)
+    """
+    pad = (win_size - 1) // 2
+    height, width = image1.shape[:2]
+    valid_height, valid_width = height - 2 * pad, width - 2 * pad
+    rows = (valid_height + tile_size - 1) // tile_size
+    cols = (valid_width + tile_size - 1) // tile_size
+    diff_map = numpy.full((rows, cols), numpy.nan)
+    total = valid_height * valid_width
+    data_range = dtype_data_range(image1.dtype)
+    distance = 0.0
+    for row, col in coarse_to_fine_order(rows, cols):
+        top = pad + row * tile_size
+        left = pad + col * tile_size
+        bottom = min(top + tile_size, pad + valid_height)
+        right = min(left + tile_size, pad + valid_width)
+        tile1 = image1[top - pad:bottom + pad, left - pad:right + pad].astype(numpy.float64)
+        tile2 = image2[top - pad:bottom + pad, left - pad:right + pad].astype(numpy.float64)
+        s = ssim_map(tile1, tile2, data_range, win_size)
+        # summed over pixels and averaged over channels, every pixel weighs the same as in the full image mean
+        area = (bottom - top) * (right - left)
+        tile_distance = float((1.0 - s).sum()) * area / s.size
+        diff_map[row, col] = tile_distance / area
+        distance += tile_distance
+        if not limit is None and distance / total > limit:
+            return TileDiff(diff = distance / total, complete = False, diff_map = diff_map)
+    return TileDiff(diff = distance / total, complete = True, diff_map = diff_map)
+
+def format_diff_map(diff_map):
+    """
+    Return diff_map as text rows for reports, '-' for tiles never compared
+    """
+    return '\n'.join(' '.join('  -  ' if numpy.isnan(value) else '{:.3f}'.format(value) for value in row) for row in diff_map)
+
+class ImageTiledSSIMComparater(ImageCacheComparater):
+    """
+    SSIM compare tile by tile that stops on pairs which can't be within max_diff or beat the
+    current worst result of the collector. Images smaller than a tile are one tile.
+    Stopped pairs only have a lower bound of their diff, they get RESULT_CODE_ERROR and their
+    files are kept in partial_files so they aren't stored as scores.
+    Args:
+        tile_size (int): tile width and height in pixel
+        max_diff (float): pairs of a larger diff are stopped early, None for no limit
+    """
+    def __init__(self, cache: ImageCache = None, prefetcher: ImagePrefetcher = None, tile_size = 128, max_diff = None, mode = 'full'):
+        super().__init__(cache, prefetcher, mode)
+        self.tile_size = tile_size
+        self.max_diff = max_diff
+        self.stopped = 0
+        self.completed = 0
+
+    def limit(self, collector: TopKCollector = None):
+        worst = None if collector is None else collector.worst()
+        if worst is None:
+            return self.max_diff
+        if self.max_diff is None:
+            return worst
+        return min(worst, self.max_diff)
+
+    def compare_tiles(self, imagepath1, imagepath2, limit = None):
+        """
+        Return TileDiff of two image files, None if they can't be compared
+        """
+        img1 = self.read_image(imagepath1)
+        img2 = self.read_image(imagepath2)
+        if img1 is None or img2 is None or not img1.dtype == img2.dtype or not img1.shape == img2.shape:
+            return None
+        if min(img1.shape[:2]) < SSIM_WIN_SIZE:
+            return None
+        result = tile_ssim(img1, img2, self.tile_size, limit)
+        if result.complete:
+            self.completed += 1
+        else:
+            self.stopped += 1
+        return result
+
+    def compare_image(self, imagepath1, imagepath2):
+        result = self.compare_tiles(imagepath1, imagepath2, self.max_diff)
+        if result is None or not result.complete:
+            return RESULT_CODE_ERROR
+        return result.diff
+
+    def compare_image_list(self, imagepath, files, collector: TopKCollector = None):
+        # a generator, the collector is updated by the caller between pairs so the limit tightens
+        self.partial_files = set()
+        for file in self.prefetched(files):
+            result = self.compare_tiles(imagepath, file, self.limit(collector))
+            if result is None:
+                yield (file, RESULT_CODE_ERROR)
+                continue
+            if not result.complete:
+                self.partial_files.add(file)
+                yield (file, RESULT_CODE_ERROR)
+                continue
+            yield (file, result.diff)
+
+    def __str__(self):
+        return 'ImageTiledSSIMComparater: completed {:d}, stopped early {:d}'.format(self.completed, self.stopped)
@@ -1,4 +1,6 @@
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 from imagehash import ImageHash
 import imagehash
@@ -7,21 +9,109 @@ import cv2
 import openpyxl
 from openpyxl import Workbook
 from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter
 
 from skimage.measure import compare_ssim
 
+from PyImgCache import ImageCache, COMPARE_MODES
+from PyImgPrefetch import ImagePrefetcher
+from PyImgHashIndex import ImageHashIndex
+from PyTopK import TopKCollector
+from PyImgStore import ComparisonStore
+from PyFileScanner import scan_folder, is_image_extension
+from PyAndroidRes import ResourceTable, folder_density, canonical_size
+
 ui_folder = 'gray'
 project_folder = 'blue'
 output_xlsx = 'result_gb.xlsx'
 max_record = 10
+max_workers = 1
+cache_bytes = 256 * 1024 * 1024
+prefetch_workers = 4
+hash_index_file = 'hash_index.json'
+store_file = 'compare_cache.db'
+# only compare images of matching density qualifiers, changes which pairs are compared
+density_aware = False
+# only compare the perceptual hash candidates of hash_index_file, changes which pairs are compared
+prefilter_enabled = False
+# one of PyImgCache.COMPARE_MODES, 'alpha' compares the shape of ui icons only
+compare_mode = 'full'
+# print the stage summary of the run
+profile = False
+# pstats file of the run, also prints the stage summary, None to disable
+profile_filepath = None
 
 RESULT_CODE_ERROR = -1
 
 class ImageComparater(object):
+    # bump when compare_image results change, scores stored by older versions are ignored
+    VERSION = 1
+
+    def store_name(self):
+        """
+        Name scores of this comparater are stored under, options that change the scores are part of it
+        """
+        return type(self).__name__
+    # files of the last compare_image_list whose diff is only a lower bound, never stored
+    partial_files = ()
 
     def compare_image(self, imagepath1, imagepath2):
         pass
 
+    def compare_image_list(self, imagepath, files, collector: TopKCollector = None):
+        """
+        Return [(file, diff)] of imagepath against each file of files,
+        comparaters may stop early on files that can't beat collector.worst()
+        """
+        return [(file, self.compare_image(imagepath, file)) for file in files]
+
+class ImageCacheComparater(ImageComparater):
+
+    def __init__(self, cache: ImageCache = None, prefetcher: ImagePrefetcher = None, mode = 'full'):
+        if cache is None:
+            cache = ImageCache()
+        if not mode in COMPARE_MODES:
+            raise ValueError('Invalid compare mode {}, must be one of {}'.format(mode, list(COMPARE_MODES)))
+        self.cache = cache
+        self.prefetcher = prefetcher
+        # channels compared, one of COMPARE_MODES
+        self.mode = mode
+        # (path, image) just handed over by the prefetcher
+        self.pinned = None
+
+    def store_name(self):
+        if 'full' == self.mode:
+            return type(self).__name__
+        return '{}.{}'.format(type(self).__name__, self.mode)
+
+    def read_image(self, imagepath):
+        if not self.pinned is None and self.pinned[0] == imagepath:
+            # used as is, an image over the cache budget or evicted meanwhile isn't decoded again
+            if self.pinned[1] is None:
+                return None
+            return self.cache.read_mode(imagepath, self.mode, self.pinned[1])
+        return self.cache.read_mode(imagepath, self.mode)
+
+    def prefetched(self, files):
+        """
+        Yield files in order, decoded ahead by the prefetcher if one is set. The image of the
+        yielded file is pinned, read_image returns it without going through the cache.
+        """
+        if self.prefetcher is None:
+            yield from files
+            return
+        for file, img in self.prefetcher.iterate(files, self.cache):
+            self.pinned = (file, img)
+            try:
+                yield file
+            finally:
+                self.pinned = None
+
+    def compare_image_list(self, imagepath, files, collector: TopKCollector = None):
+        if self.prefetcher is None:
+            return super().compare_image_list(imagepath, files, collector)
+        return [(file, self.compare_image(imagepath, file)) for file in self.prefetched(files)]
+
 class ImageHashComparater(ImageComparater):
 
     def average_hash(self, image):
@@ -42,14 +132,15 @@ class ImageHashComparater(ImageComparater):
         '''
         return imagehash.dhash_vertical(img1) - imagehash.dhash_vertical(img2)
 
-class ImageHistComparater(ImageComparater):
+class ImageHistComparater(ImageCacheComparater):
 
-    def compare_image(self, imagepath1, imagepath2):
-        img1 = cv2.imread(imagepath1, cv2.IMREAD_UNCHANGED)
-        img2 = cv2.imread(imagepath2, cv2.IMREAD_UNCHANGED)
+    def calculate_hist(self, imagepath):
+        img = self.read_image(imagepath)
+        return cv2.calcHist([img], [0], None, [256], [0, 256])
 
-        imgHist1 = cv2.calcHist([img1], [0], None, [256], [0, 256])
-        imgHist2 = cv2.calcHist([img2], [0], None, [256], [0, 256])
+    def compare_image(self, imagepath1, imagepath2):
+        imgHist1 = self.cache.get(imagepath1, 'hist.' + self.mode, self.calculate_hist)
+        imgHist2 = self.cache.get(imagepath2, 'hist.' + self.mode, self.calculate_hist)
 
         img_hist_diff = cv2.compareHist(imgHist1, imgHist2, cv2.HISTCMP_BHATTACHARYYA)
         #print 'img_hist_diff=', img_hist_diff
@@ -58,22 +149,51 @@ class ImageHistComparater(ImageComparater):
         #print 'img_template_diff=', img_template_diff
         return (img_hist_diff / 10) + img_template_diff
 
-class ImageSSIMComparater(ImageComparater):
+class ImageSSIMComparater(ImageCacheComparater):
 
     def compare_image(self, imagepath1, imagepath2):
-        img1 = cv2.imread(imagepath1, cv2.IMREAD_UNCHANGED)
-        img2 = cv2.imread(imagepath2, cv2.IMREAD_UNCHANGED)
-        if not img1.dtype == img2.dtype or not img1.shape == img2.shape:
+        img1 = self.read_image(imagepath1)
+        img2 = self.read_image(imagepath2)
+        if img1 is None or img2 is None or not img1.dtype == img2.dtype or not img1.shape == img2.shape:
             #print ('Invalid compare inputs: left={}{}, right={}{}'.format(img1.dtype, img1.shape, img2.dtype, img2.shape))
             return RESULT_CODE_ERROR;
         
         try:
-            bgrScore = compare_ssim(img1, img2, multichannel=True)
+            bgrScore = compare_ssim(img1, img2, multichannel=img1.ndim == 3)
         except ValueError:
             print ('Invalid compare inputs: left={}{}{}, right={}{}{}'.format(imagepath1, img1.dtype, img1.shape, imagepath2, img2.dtype, img2.shape))
             return RESULT_CODE_ERROR;
         return 1.0 - bgrScore
 
+class ImageDensitySSIMComparater(ImageSSIMComparater):
+    """
+    SSIM of images scaled once to the baseline density of their folder qualifier,
+    finds the same asset across densities, e.g. drawable-xhdpi against xxhdpi
+    """
+    CANONICAL = 'canonical'
+
+    def canonical_image(self, imagepath):
+        img = self.read_image(imagepath)
+        if img is None:
+            return img
+        width, height = canonical_size(img.shape[1], img.shape[0], folder_density(imagepath))
+        if (width, height) == (img.shape[1], img.shape[0]) or min(width, height) < 7:
+            return img
+        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        img.flags.writeable = False
+        return img
+
+    def compare_image(self, imagepath1, imagepath2):
+        img1 = self.cache.get(imagepath1, ImageDensitySSIMComparater.CANONICAL + '.' + self.mode, self.canonical_image)
+        img2 = self.cache.get(imagepath2, ImageDensitySSIMComparater.CANONICAL + '.' + self.mode, self.canonical_image)
+        if img1 is None or img2 is None or not img1.dtype == img2.dtype or not img1.shape == img2.shape:
+            return RESULT_CODE_ERROR
+        try:
+            bgrScore = compare_ssim(img1, img2, multichannel=img1.ndim == 3)
+        except ValueError:
+            return RESULT_CODE_ERROR
+        return 1.0 - bgrScore
+
 class CmpResult(object):
     def __init__(self, leftpath, rightpath, diff):
         self.leftpath = leftpath
@@ -85,73 +205,150 @@ class CmpResult(object):
 
 class ImageFileFolderComparater(object):
 
-    def __init__(self, max_record, printer, comparater):
+    def __init__(self, max_record, printer, comparater, max_workers = 1, prefilter: ImageHashIndex = None, store: ComparisonStore = None, density_aware = False):
         self.max_record = max_record
         self.result_list = []
+        self.collector = TopKCollector(max_record)
         self.printer = printer
         self.comparater = comparater
+        self.max_workers = max_workers
+        self.prefilter = prefilter
+        self.store = store
+        # only compare images of matching density qualifiers when set
+        self.density_aware = density_aware
+        self.resources = None
 
     def is_imagefile(self, imagepath):
         if not os.path.isfile(imagepath):
             return False
-        split = imagepath.split('.')
-        if 'png' == split[len(split) - 1] or 'jpg' == split[len(split) - 1]:
-            return True
-        return False
-
-    def add_result(self, result): 
-        length = len(self.result_list)
-        position = -1
-        for i in range(length):
-            record = self.result_list[i]
-            if record.diff > result.diff:
-                position = i
-                break
-        if length < self.max_record:
-            self.result_list.append(0)
-            if -1 == position:
-                self.result_list[length] = result
-                return
-            length += 1
-        else:
-            if -1 == position:
-                return
-        for i in range(length - 1, position, -1):
-            self.result_list[i] = self.result_list[i - 1]
-        self.result_list[position] = result
+        return is_image_extension(imagepath)
+
+    def add_result(self, imagepath, file, diff):
+        self.collector.add((imagepath, file, diff), diff)
+
+    def collect_results(self):
+        """
+        Move the collected best results of the current image into result_list
+        """
+        self.result_list = [CmpResult(leftpath, rightpath, diff) for leftpath, rightpath, diff in self.collector.results()]
+        self.collector.clear()
+        return self.result_list
 
     def print_results(self):
         for result in self.result_list:
             print (result.leftpath, ' - ', result.rightpath, '=', result.diff)
 
+    def list_image_files(self, folderpath):
+        """
+        Return image files under folderpath, walked once in directory order
+        """
+        return [entry.path for entry in scan_folder(folderpath)]
+
+    def compare_file_list(self, imagepath, files):
+        if not self.store is None:
+            files = self.compare_stored(imagepath, files)
+        for file, diff in self.comparater.compare_image_list(imagepath, files, self.collector):
+            # diffs of pairs stopped early are lower bounds, neither stored nor collected
+            if file in self.comparater.partial_files:
+                continue
+            if not self.store is None:
+                self.store.put_pair(imagepath, file, self.comparater.store_name(), diff, self.comparater.VERSION)
+            if not RESULT_CODE_ERROR == diff:
+                self.add_result(imagepath, file, diff)
+
+    def compare_stored(self, imagepath, files):
+        """
+        Add results of pairs already scored in the store, return the files that still need a compare
+        """
+        name = self.comparater.store_name()
+        missing = []
+        for file in files:
+            diff = self.store.get_pair(imagepath, file, name, self.comparater.VERSION)
+            if diff is None:
+                missing.append(file)
+            elif not RESULT_CODE_ERROR == diff:
+                self.add_result(imagepath, file, diff)
+        return missing
+
+    def compare_candidates(self, imagepath, files):
+        """
+        Compare imagepath against prefilter candidates if a prefilter is set, otherwise against all files
+        """
+        if not self.prefilter is None:
+            files = self.prefilter.query(imagepath)
+            if not self.resources is None:
+                files = self.resources.candidates(imagepath, files)
+        elif not self.resources is None:
+            # the table holds the same files, its density lists are reused
+            files = self.resources.candidates(imagepath)
+        self.compare_file_list(imagepath, files)
+
+    def index_right_files(self, rightfiles):
+        if not self.prefilter is None:
+            self.prefilter.update(rightfiles)
+        if self.density_aware:
+            self.resources = ResourceTable(rightfiles)
+
     def compare_file_folder(self, imagepath, folderpath):
-        for file in os.listdir(folderpath):
-            file = os.path.join(folderpath, file)
-            if self.is_imagefile(file):
-                diff = self.comparater.compare_image(imagepath, file)
-                if not RESULT_CODE_ERROR == diff:
-                    #print ('compare_image: {} with {}, diff={}'.format(imagepath, file, diff))
-                    self.add_result(CmpResult(imagepath, file, diff))
-                #self.print_results()
-            elif os.path.isdir(file):
-                self.compare_file_folder(imagepath, file)
+        self.compare_file_list(imagepath, self.list_image_files(folderpath))
+
+    def compare_parallel(self, leftfolder, rightfolder):
+        """
+        Fan left images out to a process pool, each worker compares one left image
+        against all right images. Results are printed in left folder order.
+        """
+        leftfiles = self.list_image_files(leftfolder)
+        rightfiles = self.list_image_files(rightfolder)
+        chunksize = max(1, len(leftfiles) // (self.max_workers * 4))
+        self.index_right_files(rightfiles)
+        # spawn like on Windows, forking while decode threads are running may deadlock the workers
+        with ProcessPoolExecutor(self.max_workers, multiprocessing.get_context('spawn'), initializer=init_compare_worker,
+                                 initargs=(self.max_record, self.comparater, rightfiles, self.prefilter, self.store, self.resources)) as executor:
+            for result_list in executor.map(compare_worker_image, leftfiles, chunksize=chunksize):
+                self.result_list = result_list
+                self.printer.printxlsx(self.result_list)
 
     def compare(self, leftfolder, rightfolder):
-        for file in os.listdir(leftfolder):
-            file = os.path.join(leftfolder, file)
-            if self.is_imagefile(file):
-                del self.result_list[:]
-                self.compare_file_folder(file, rightfolder)
-                printer.printxlsx(self.result_list)
-            elif os.path.isdir(file):
-                self.compare(file, rightfolder)
-        
+        if self.max_workers > 1:
+            self.compare_parallel(leftfolder, rightfolder)
+            return
+        # the right tree is walked once, not once per left image
+        rightfiles = self.list_image_files(rightfolder)
+        self.index_right_files(rightfiles)
+        for file in self.list_image_files(leftfolder):
+            self.compare_candidates(file, rightfiles)
+            self.printer.printxlsx(self.collect_results())
+
+# per worker process state of ImageFileFolderComparater.compare_parallel
+worker_comparater = None
+worker_rightfiles = []
+
+def init_compare_worker(max_record, comparater, rightfiles, prefilter = None, store = None, resources: ResourceTable = None):
+    global worker_comparater, worker_rightfiles
+    worker_comparater = ImageFileFolderComparater(max_record, None, comparater, prefilter=prefilter, store=store)
+    worker_comparater.resources = resources
+    worker_rightfiles = rightfiles
+
+def compare_worker_image(imagepath):
+    worker_comparater.compare_candidates(imagepath, worker_rightfiles)
+    if not worker_comparater.store is None:
+        worker_comparater.store.commit()
+    return worker_comparater.collect_results()
 
 class XlsxPrinter(object):
 
-    def __init__(self, filename):
+    def __init__(self, filename, checkpoint = 0):
+        """
+        Args:
+            filename: excel file name
+            checkpoint: save every checkpoint printxlsx calls, 0 to only save in finish_print
+        """
         self.filename = filename
         self.current_row = 1
+        self.checkpoint = checkpoint
+        self.print_count = 0
+        # column letter -> width, kept up to date as cells are written
+        self.dims = {}
 
     def openxlsx(self, filename):
         for file in os.listdir('.'):
@@ -166,35 +363,52 @@ class XlsxPrinter(object):
 
     def begin_print(self):
         self.xlsx_file = self.openxlsx(self.filename)
+        self.dims = {}
+        for row in self.xlsx_file.active.rows:
+            for cell in row:
+                if cell.value:
+                    self.dims[cell.column_letter] = max(self.dims.get(cell.column_letter, 0), len(str(cell.value)))
+
+    def write_cell(self, ws, column, value):
+        ws.cell(row = self.current_row, column = column, value = value)
+        letter = get_column_letter(column)
+        self.dims[letter] = max(self.dims.get(letter, 0), len(str(value)))
 
     def printxlsx(self, compare_results):
         ws = self.xlsx_file.active
         length = len(compare_results)
         for i in range(0, length):
             result = compare_results[i]
-            ws.cell(row = self.current_row, column = 1, value = result.leftpath)
-            ws.cell(row = self.current_row, column = 2, value = result.rightpath)
-            ws.cell(row = self.current_row, column = 3, value = '{:<.10f}'.format(result.diff))
+            self.write_cell(ws, 1, result.leftpath)
+            self.write_cell(ws, 2, result.rightpath)
+            self.write_cell(ws, 3, '{:<.10f}'.format(result.diff))
             self.current_row += 1
 
         self.current_row += 1
-        self.finish_print()
+        self.print_count += 1
+        if self.checkpoint > 0 and 0 == self.print_count % self.checkpoint:
+            self.finish_print()
 
     def finish_print(self):
         ws = self.xlsx_file.active
         #format column width
-        dims = {}
-        for row in ws.rows:
-            for cell in row:
-                if cell.value:
-                    dims[cell.column_letter] = max(dims.get(cell.column_letter, 0), len(str(cell.value)))
-        for col, value in dims.items():
+        for col, value in self.dims.items():
             ws.column_dimensions[col].width = value
         self.xlsx_file.save(self.filename)    
 
 if __name__ == '__main__':
-    printer = XlsxPrinter(output_xlsx)    
-    printer.begin_print()
-    comparater = ImageFileFolderComparater(max_record, printer, ImageSSIMComparater())
-    comparater.compare(project_folder, ui_folder)
-    printer.finish_print()
+    from PyImgProfile import profiled
+    with profiled(profile_filepath, enabled = profile or not profile_filepath is None):
+        printer = XlsxPrinter(output_xlsx)    
+        printer.begin_print()
+        image_cache = ImageCache(cache_bytes)
+        prefetcher = ImagePrefetcher(prefetch_workers)
+        store = ComparisonStore(store_file)
+        prefilter = None
+        if prefilter_enabled:
+            prefilter = ImageHashIndex(hash_index_file, top_k = max_record * 4, store = store)
+        comparater = ImageFileFolderComparater(max_record, printer, ImageSSIMComparater(image_cache, prefetcher, compare_mode), max_workers, prefilter, store, density_aware)
+        comparater.compare(project_folder, ui_folder)
+        store.close()
+        printer.finish_print()
+        print(image_cache)
@@ -0,0 +1,151 @@
+import csv
+import json
+import array
+
+RESULT_FIELDS = ['left', 'right', 'score', 'code', 'reason']
+
+class ResultStore(object):
+    """
+    Compact array backed store of compare results. Paths and reasons are interned as indices,
+    scores are kept in a float array and codes in an int8 array, no object per result.
+    """
+    def __init__(self):
+        self.strings = []
+        self.string_index = dict()
+        self.left = array.array('l')
+        self.right = array.array('l')
+        self.scores = array.array('d')
+        self.codes = array.array('b')
+        self.reasons = array.array('l')
+
+    def intern(self, value):
+        index = self.string_index.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.string_index[value] = index
+            self.strings.append(value)
+        return index
+
+    def append(self, leftpath, rightpath, score, code = 0, reason = ''):
+        self.left.append(self.intern(leftpath))
+        self.right.append(self.intern(rightpath))
+        self.scores.append(score)
+        self.codes.append(code)
+        self.reasons.append(self.intern(reason))
+
+    def rows(self):
+        """
+        Yield (left, right, score, code, reason) of every result in insertion order
+        """
+        strings = self.strings
+        for i in range(len(self.scores)):
+            yield (strings[self.left[i]], strings[self.right[i]], self.scores[i], self.codes[i], strings[self.reasons[i]])
+
+    def clear(self):
+        self.__init__()
+
+    def __len__(self):
+        return len(self.scores)
+
+class ResultExporter(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def export(self, store: ResultStore):
+        pass
+
+class CsvExporter(ResultExporter):
+    def export(self, store: ResultStore):
+        with open(self.filepath, 'w', newline='', encoding='utf-8') as output:
+            writer = csv.writer(output)
+            writer.writerow(RESULT_FIELDS)
+            writer.writerows(store.rows())
+
+class JsonlExporter(ResultExporter):
+    def export(self, store: ResultStore):
+        with open(self.filepath, 'w', encoding='utf-8') as output:
+            for row in store.rows():
+                output.write(json.dumps(dict(zip(RESULT_FIELDS, row))))
+                output.write('\n')
+
+class ParquetExporter(ResultExporter):
+    """
+    Need pyarrow, paths are written as a dictionary encoded column over the interned strings
+    """
+    def export(self, store: ResultStore):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('ParquetExporter needs pyarrow, install it or use CsvExporter/JsonlExporter')
+        strings = pyarrow.array(store.strings, pyarrow.string())
+        def column(indices):
+            return pyarrow.DictionaryArray.from_arrays(pyarrow.array(indices, pyarrow.int64()), strings)
+        table = pyarrow.table({
+            'left': column(store.left),
+            'right': column(store.right),
+            'score': pyarrow.array(store.scores, pyarrow.float64()),
+            'code': pyarrow.array(store.codes, pyarrow.int8()),
+            'reason': column(store.reasons),
+        })
+        pyarrow.parquet.write_table(table, self.filepath)
+
+class XlsxExporter(ResultExporter):
+    def export(self, store: ResultStore):
+        from openpyxl import Workbook
+        wbk = Workbook(write_only=True)
+        ws = wbk.create_sheet()
+        ws.append(RESULT_FIELDS)
+        for row in store.rows():
+            ws.append(row)
+        wbk.save(self.filepath)
+
+EXPORTERS = {
+    'csv': CsvExporter,
+    'jsonl': JsonlExporter,
+    'parquet': ParquetExporter,
+    'xlsx': XlsxExporter,
+}
+
+def get_exporter(filepath) -> ResultExporter:
+    """
+    Return the exporter matching the file extension of filepath
+    """
+    extension = filepath.rsplit('.', 1)[-1].lower()
+    if not extension in EXPORTERS:
+        raise ValueError('Invalid export file {}, extension must be one of {}'.format(filepath, list(EXPORTERS)))
+    return EXPORTERS[extension](filepath)
+
+class ResultStorePrinter(object):
+    """
+    Keep compare results in a ResultStore instead of a workbook, exported in finish_print.
+    Prints ImageFileFolderComparater results with printxlsx and ImageFolderCompareTask results
+    with print like PyImgCmp.ExcelPrinter, only the sheet ExcelPrinter would pick is kept.
+    Args:
+        store (ResultStore): result store
+        exporters (list): exporters run in finish_print
+    """
+    def __init__(self, store: ResultStore = None, exporters = None):
+        if store is None:
+            store = ResultStore()
+        self.store = store
+        self.exporters = exporters if not exporters is None else []
+
+    def begin_print(self):
+        pass
+
+    def printxlsx(self, compare_results):
+        for result in compare_results:
+            self.store.append(result.leftpath, result.rightpath, result.diff)
+
+    def print(self, compare_task):
+        for results_list in [compare_task.equal_list, compare_task.similar_list, compare_task.error_list]:
+            if not len(results_list) == 0:
+                for result in results_list:
+                    self.store.append(result.imagefile, result.otherfile, result.diff, result.code, result.reason)
+                return
+        print('{} no record !!!'.format(compare_task.imagefile))
+
+    def finish_print(self):
+        for exporter in self.exporters:
+            exporter.export(self.store)
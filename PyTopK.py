@@ -0,0 +1,62 @@
+import heapq
+import itertools
+import operator
+
+class TopKCollector(object):
+    """
+    Streaming bounded collector of the max_record best items, lower score is better.
+    Among equal scores the earlier item wins, same as a stable sorted insert.
+    Args:
+        max_record (int): number of items kept
+        key (callable): item -> score, used when add is called without score
+        threshold (float): items scored above threshold are rejected, None to accept any score
+    """
+    def __init__(self, max_record, key = operator.attrgetter('diff'), threshold = None):
+        self.max_record = max_record
+        self.key = key
+        self.threshold = threshold
+        # max heap of (-score, -order, item), heap[0] is the current worst item
+        self.heap = []
+        self.counter = itertools.count()
+
+    def worst(self):
+        """
+        Return the score an item must beat to be kept, None while any score is kept
+        """
+        if len(self.heap) < self.max_record:
+            return self.threshold
+        return -self.heap[0][0]
+
+    def accepts(self, score) -> bool:
+        if self.max_record <= 0:
+            return False
+        if len(self.heap) < self.max_record:
+            return self.threshold is None or score <= self.threshold
+        return score < -self.heap[0][0]
+
+    def add(self, item, score = None) -> bool:
+        """
+        Offer item, return True if it is kept
+        """
+        if score is None:
+            score = self.key(item)
+        if not self.accepts(score):
+            return False
+        entry = (-score, -next(self.counter), item)
+        if len(self.heap) < self.max_record:
+            heapq.heappush(self.heap, entry)
+        else:
+            heapq.heapreplace(self.heap, entry)
+        return True
+
+    def results(self):
+        """
+        Return kept items, best first
+        """
+        return [entry[2] for entry in sorted(self.heap, key=lambda entry: (-entry[0], -entry[1]))]
+
+    def clear(self):
+        del self.heap[:]
+
+    def __len__(self):
+        return len(self.heap)
@@ -1,6 +1,13 @@
 import os
+import json
+import time
+import threading
+import contextlib
+import collections
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from PyImgCmp import *
+from PyImgProfile import profiled
 import shutil
 import re
 
@@ -18,58 +25,309 @@ def get_proj_drawable_folders(proj_folder):
     proj_drawable_folders = []
     drawable_pattern = re.compile('^.*drawable$')
     mipmap_pattern = re.compile('^.*mipmap.*$')
-    for file in os.listdir(proj_res_folder):
-        file = os.path.join(proj_res_folder, file)
-        if os.path.isdir(file):
-            if drawable_pattern.match(str(file)) or mipmap_pattern.match(str(file)):
-                proj_drawable_folders.append(file)
+    with os.scandir(proj_res_folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if drawable_pattern.match(entry.path) or mipmap_pattern.match(entry.path):
+                    proj_drawable_folders.append(entry.path)
     return proj_drawable_folders
 
 APKTOOL_EXE = 'apktool.exe'
 apktool_filepath = resource_path(APKTOOL_EXE)
 
-def decode_apk(apk_filepath, output_folder):
-    splits = apk_filepath.split('\\')
-    apk_filename = splits[len(splits) - 1]
-    splits = apk_filename.split('.')
-    decode_folder = splits[0]
-    decode_folder = '{}\\{}'.format(output_folder, decode_folder)
-
-    batcmd = '{} d -f {} -o {}'.format(apktool_filepath, apk_filepath, decode_folder)
-    result = subprocess.check_output(batcmd, shell=True)
+def decode_apk(apk_filepath, output_folder, decode_folder = None):
+    if decode_folder is None:
+        decode_folder = os.path.join(output_folder, os.path.basename(apk_filepath).split('.')[0])
+    # arguments as a list, no shell to start and no quoting issue with spaces in paths
+    subprocess.check_output([apktool_filepath, 'd', '-f', apk_filepath, '-o', decode_folder])
     return decode_folder
 
 def build_apk(decode_folder, output_folder):
-    splits = decode_folder.split('\\')
-    apk_filename = '{}.apk'.format(splits[len(splits) - 1])
-    build_filepath = '{}\\{}'.format(output_folder, apk_filename)
+    apk_filename = '{}.apk'.format(os.path.basename(decode_folder))
+    build_filepath = os.path.join(output_folder, apk_filename)
     #aapt1 won't do png file improving, which may cause apk file too large or even failure
     #solution 1, use -nc, won't do png file compress
     #solution 2, use -use-aapt2, will do png file compress if needed
     #add -c to Copy original files, AndroidManifest.xml, META-INF to maintian signature info
-    batcmd = '{} b -use-aapt2 -c {} -o {}'.format(apktool_filepath, decode_folder, build_filepath)
-    result = subprocess.check_output(batcmd, shell=True)
+    subprocess.check_output([apktool_filepath, 'b', '-use-aapt2', '-c', decode_folder, '-o', build_filepath])
     return build_filepath
 
+def link_or_copy(src, dst):
+    """
+    Hard link dst to src, copy when the file system can't link. ImageReplaceTask removes a file
+    before writing its replacement, so a linked file of the template is never written through.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+def remove_file(path):
+    """
+    Remove path before a new file is written to it, so a file hard linked to the template
+    is never written through. Return False if path is still there.
+    """
+    if not os.path.lexists(path):
+        return True
+    try:
+        os.remove(path)
+    except OSError as e:
+        print ("Error: %s - %s." % (e.filename, e.strerror))
+        return False
+    return True
+
+def clone_decode_folder(decode_folder, clone_folder):
+    """
+    Copy a decoded apk tree with hard links, an existing clone_folder is replaced.
+    Raise ValueError if clone_folder is decode_folder or holds it, it would be deleted.
+    """
+    source = os.path.normcase(os.path.realpath(decode_folder))
+    target = os.path.normcase(os.path.realpath(clone_folder))
+    if source == target or source.startswith(os.path.join(target, '')):
+        raise ValueError('Clone folder {} would replace the decoded template {}'.format(clone_folder, decode_folder))
+    if os.path.isdir(clone_folder):
+        shutil.rmtree(clone_folder)
+    shutil.copytree(decode_folder, clone_folder, copy_function=link_or_copy)
+    return clone_folder
+
+class StageTimer(object):
+    """
+    Wall clock seconds per stage, summed over skins, safe to use from build threads
+    """
+    def __init__(self):
+        self.seconds = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+                self.counts[name] = self.counts.get(name, 0) + 1
+
+    def report(self):
+        lines = ['{:<12}{:>8}{:>12}'.format('stage', 'count', 'seconds')]
+        for name, seconds in self.seconds.items():
+            lines.append('{:<12}{:>8d}{:>12.3f}'.format(name, self.counts[name], seconds))
+        return '\n'.join(lines)
+
 class ImageReplaceTask(ImageFolderCompareTask):
+    def __init__(self, folders1, folders2, printer: ResultPrinter, backend: MetadataBackend = None, comparater: ImageComparater = None, digest_cache: ContentDigestCache = None, density_aware = False):
+        super().__init__(folders1, folders2, printer, backend, comparater, density_aware)
+        if digest_cache is None:
+            digest_cache = default_digest_cache
+        self.digest_cache = digest_cache
+        self.replaced_count = 0
+        self.unchanged_count = 0
+
     def start_file_compare_task(self, file):
         file_compare_task = super().start_file_compare_task(file)
         equal_results = file_compare_task.equal_list
         if not len(equal_results) == 0:
             old_file = equal_results[0].imagefile
             new_file = equal_results[0].otherfile
-            print('replace {} with {}'.format(old_file, new_file))
-            if os.path.isfile(old_file):
-                # 1. Remove old file
-                try:
-                    os.remove(old_file)
-                except OSError as e:
-                    print ("Error: %s - %s." % (e.filename, e.strerror))
-            # 2. copy new file
-            shutil.copy(new_file, old_file)
+            if os.path.isfile(old_file) and self.digest_cache.equal(old_file, new_file):
+                # byte identical, skip the write
+                self.unchanged_count += 1
+                return file_compare_task
+            self.replaced_count += 1
+            self.replace_file(old_file, new_file)
         return file_compare_task
 
-def main(skin_template_apk, ui_folders, output_folder, excel_filename):
+    def replace_file(self, old_file, new_file):
+        print('replace {} with {}'.format(old_file, new_file))
+        # 1. Remove old file, skip the copy if it can't be removed
+        if not remove_file(old_file):
+            return
+        # 2. copy new file
+        shutil.copy(new_file, old_file)
+
+    def start(self):
+        super().start()
+        print('replaced {:d} files, {:d} files unchanged'.format(self.replaced_count, self.unchanged_count))
+
+class ReplacePlanTask(ImageReplaceTask):
+    """
+    Match resources of a pristine decoded tree like ImageReplaceTask, but only record
+    relative path -> ui file of each replacement instead of writing it
+    """
+    def __init__(self, decode_folder, folders1, folders2, printer: ResultPrinter, backend: MetadataBackend = None, comparater: ImageComparater = None, digest_cache: ContentDigestCache = None, density_aware = False):
+        super().__init__(folders1, folders2, printer, backend, comparater, digest_cache, density_aware)
+        self.decode_folder = decode_folder
+        self.plan = dict()
+
+    def replace_file(self, old_file, new_file):
+        self.plan[os.path.relpath(old_file, self.decode_folder)] = new_file
+
+    def start(self):
+        ImageFolderCompareTask.start(self)
+        print('matched {:d} files, {:d} files same as template'.format(self.replaced_count, self.unchanged_count))
+
+class ReplaceManifest(object):
+    """
+    Json record of the replacements applied to a working tree, relative path ->
+    [ui file, size, mtime, digest], and the digest of the template apk it was decoded from
+    """
+    VERSION = 1
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.template_digest = None
+        self.entries = dict()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.filepath):
+            return
+        with open(self.filepath, 'r') as input:
+            content = json.load(input)
+        if content.get('version') == ReplaceManifest.VERSION:
+            self.template_digest = content.get('template')
+            self.entries = content.get('entries', {})
+
+    def save(self):
+        with open(self.filepath, 'w') as output:
+            json.dump({'version': ReplaceManifest.VERSION, 'template': self.template_digest, 'entries': self.entries}, output, indent=1)
+
+    def reset(self, template_digest):
+        self.template_digest = template_digest
+        self.entries = dict()
+
+def restore_file(pristine_folder, working_folder, relpath):
+    working_file = os.path.join(working_folder, relpath)
+    if not remove_file(working_file):
+        return False
+    link_or_copy(os.path.join(pristine_folder, relpath), working_file)
+    return True
+
+def apply_replace_plan(plan, manifest: ReplaceManifest, pristine_folder, working_folder, digest_cache: ContentDigestCache):
+    """
+    Bring working_folder from the replacements of manifest to plan, only new, changed and removed
+    replacements are written, dropped ones are restored from pristine_folder
+    Returns:
+        tuple: (written, restored, unchanged) counts
+    """
+    written = restored = unchanged = 0
+    entries = dict()
+    for relpath, new_file in plan.items():
+        stat = os.stat(new_file)
+        entry = manifest.entries.get(relpath)
+        if not entry is None and entry[0] == new_file and entry[1] == stat.st_size and entry[2] == stat.st_mtime_ns:
+            entries[relpath] = entry
+            unchanged += 1
+            continue
+        digest = digest_cache.digest(new_file)
+        entries[relpath] = [new_file, stat.st_size, stat.st_mtime_ns, digest]
+        if not entry is None and entry[3] == digest:
+            # touched or moved but the same bytes
+            unchanged += 1
+            continue
+        working_file = os.path.join(working_folder, relpath)
+        print('replace {} with {}'.format(working_file, new_file))
+        if not remove_file(working_file):
+            # recorded as not applied, tried again by the next run
+            entries.pop(relpath)
+            continue
+        shutil.copy(new_file, working_file)
+        written += 1
+    for relpath in manifest.entries:
+        if not relpath in plan:
+            print('restore {}'.format(os.path.join(working_folder, relpath)))
+            if restore_file(pristine_folder, working_folder, relpath):
+                restored += 1
+            else:
+                # still replaced, restored by the next run
+                entries[relpath] = manifest.entries[relpath]
+    manifest.entries = entries
+    return (written, restored, unchanged)
+
+def incremental_main(skin_template_apk, ui_folders, output_folder, excel_filename, cache_filepath = None, density_aware = False, profile = False, profile_filepath = None):
+    """
+    Same as main, but keep the decoded template and the working tree between runs and only apply
+    the ui files new, changed or removed since the last run. The template is decoded again only when
+    its digest changes, and the apk is not built again when nothing changed.
+    Args: same as main
+    Returns:
+        str: built apk file path
+    """
+    with profiled(profile_filepath, enabled = profile or not profile_filepath is None):
+        return run_incremental_main(skin_template_apk, ui_folders, output_folder, excel_filename, cache_filepath, density_aware)
+
+def run_incremental_main(skin_template_apk, ui_folders, output_folder, excel_filename, cache_filepath, density_aware):
+    timer = StageTimer()
+    name = os.path.basename(skin_template_apk).split('.')[0]
+    pristine_folder = os.path.join(output_folder, '{}.template'.format(name))
+    working_folder = os.path.join(output_folder, name)
+    build_filepath = os.path.join(output_folder, '{}.apk'.format(name))
+    store, backend, digest_cache = open_cache(cache_filepath)
+    if digest_cache is None:
+        digest_cache = default_digest_cache
+    manifest = ReplaceManifest(os.path.join(output_folder, '{}.replace.json'.format(name)))
+
+    template_digest = digest_cache.digest(skin_template_apk)
+    # a new working tree is built even when no replacement changed
+    rebuild = not manifest.template_digest == template_digest or not os.path.isdir(pristine_folder) or not os.path.isdir(working_folder)
+    if rebuild:
+        with timer.stage('decode'):
+            decode_apk(skin_template_apk, output_folder, pristine_folder)
+            clone_decode_folder(pristine_folder, working_folder)
+        manifest.reset(template_digest)
+    print('decode folder: ', working_folder)
+
+    # match against the pristine tree, the working tree already holds earlier replacements
+    with timer.stage('match'):
+        excel_filepath = os.path.join(output_folder, excel_filename)
+        task = ReplacePlanTask(pristine_folder, get_proj_drawable_folders(pristine_folder), ui_folders, ExcelPrinter(excel_filepath), backend, digest_cache = digest_cache, density_aware = density_aware)
+        task.start()
+    with timer.stage('apply'):
+        written, restored, unchanged = apply_replace_plan(task.plan, manifest, pristine_folder, working_folder, digest_cache)
+    print('written {:d} files, restored {:d} files, {:d} files unchanged'.format(written, restored, unchanged))
+    if not store is None:
+        store.close()
+
+    if rebuild or written or restored or not os.path.isfile(build_filepath):
+        with timer.stage('build'):
+            build_filepath = build_apk(working_folder, output_folder)
+        print('build apk: ', build_filepath)
+    else:
+        print('apk up to date: ', build_filepath)
+    # saved last, a failed build is retried by the next run
+    manifest.save()
+    print(timer.report())
+    return build_filepath
+
+skin_fields = ['name', 'ui_folders', 'excel_filename']
+
+class SkinDefinition(collections.namedtuple('SkinDefinition', skin_fields)):
+    """
+    One skin of a batch, name is the decode folder and apk file name of the skin
+    """
+    pass
+
+def replace_resources(decode_folder, ui_folders, excel_filepath, backend: MetadataBackend, digest_cache: ContentDigestCache = None, density_aware = False):
+    proj_drawable_folders = get_proj_drawable_folders(decode_folder)
+    print('project drawable folders: ', proj_drawable_folders)
+    comparater = ImageReplaceTask(proj_drawable_folders, ui_folders, ExcelPrinter(excel_filepath), backend, digest_cache = digest_cache, density_aware = density_aware)
+    comparater.start()
+    print('Report excel file: ', excel_filepath)
+
+def open_cache(cache_filepath):
+    """
+    Return (store, backend, digest_cache) of the compare cache. Without cache_filepath all three are None
+    and the default PIL backend is used, with it image info is read by the struct backend and kept in the store.
+    """
+    if cache_filepath is None:
+        return (None, None, None)
+    store = ComparisonStore(cache_filepath)
+    return (store, StoreMetadataBackend(get_metadata_backend('struct'), store), ContentDigestCache(store = store))
+
+def main(skin_template_apk, ui_folders, output_folder, excel_filename, cache_filepath = None, density_aware = False, profile = False, profile_filepath = None):
     """
     Do image file compare between ui folders and project folders.
     Output report excel file and new skin apk package
@@ -78,29 +336,90 @@ def main(skin_template_apk, ui_folders, output_folder, excel_filename):
         ui_folders: new skin ui resource folders, must be a list
         output_folder: report file and new apk file output folder
         excel_filename: report file name
+        cache_filepath: compare cache file kept between runs, None to disable
+        density_aware: only replace resources by ui images of a matching density qualifier, off by default
+        profile: print the time, call count and bytes read per stage of the run
+        profile_filepath: cProfile stats file of the run, also prints the stage summary, None to disable
     """
+    with profiled(profile_filepath, enabled = profile or not profile_filepath is None):
+        run_main(skin_template_apk, ui_folders, output_folder, excel_filename, cache_filepath, density_aware)
+
+def run_main(skin_template_apk, ui_folders, output_folder, excel_filename, cache_filepath, density_aware):
     # Step1, decode apk package
     decode_folder = decode_apk(skin_template_apk, output_folder)
     print('decode folder: ', decode_folder)
 
     # Step2, replace matched resources
-    proj_drawable_folders = get_proj_drawable_folders(decode_folder)
-    print('project drawable folders: ', proj_drawable_folders)
-
-    excel_filepath = '{}\\{}'.format(output_folder, excel_filename)
-    comparater = ImageReplaceTask(proj_drawable_folders, ui_folders, ExcelPrinter(excel_filepath))
-    comparater.start()
-    print('Report excel file: ', excel_filepath)
+    excel_filepath = os.path.join(output_folder, excel_filename)
+    store, backend, digest_cache = open_cache(cache_filepath)
+    replace_resources(decode_folder, ui_folders, excel_filepath, backend, digest_cache, density_aware)
+    if not store is None:
+        store.close()
 
     # Step3, build apk package
     build_filepath = build_apk(decode_folder, output_folder)
     print('build apk: ', build_filepath)
 
+def batch_main(skin_template_apk, skins, output_folder, cache_filepath = None, max_builds = 2, density_aware = False, profile = False, profile_filepath = None):
+    """
+    Generate several skins from one template apk. The template is decoded once and its tree is
+    hard linked per skin, resources are replaced skin by skin while the apktool builds of finished
+    skins run on a pool of at most max_builds processes.
+    Args:
+        skin_template_apk: old skin apk package file path
+        skins: SkinDefinition list
+        output_folder: report files and new apk files output folder
+        cache_filepath: compare cache file kept between runs, None to disable
+        max_builds: max concurrent apktool builds
+        density_aware: only replace resources by ui images of a matching density qualifier, off by default
+        profile, profile_filepath: same as main
+    Returns:
+        list: built apk file paths in skins order
+    """
+    with profiled(profile_filepath, enabled = profile or not profile_filepath is None):
+        return run_batch_main(skin_template_apk, skins, output_folder, cache_filepath, max_builds, density_aware)
+
+def run_batch_main(skin_template_apk, skins, output_folder, cache_filepath, max_builds, density_aware):
+    timer = StageTimer()
+    with timer.stage('decode'):
+        decode_folder = decode_apk(skin_template_apk, output_folder)
+    print('decode folder: ', decode_folder)
+
+    # checked before any skin is cloned, a skin named like the template would delete it
+    for skin in skins:
+        if os.path.normcase(os.path.realpath(os.path.join(output_folder, skin.name))) == os.path.normcase(os.path.realpath(decode_folder)):
+            raise ValueError('Skin name {} is the decode folder of the template'.format(skin.name))
+
+    store, backend, digest_cache = open_cache(cache_filepath)
+    builds = []
+    # the builds are apktool processes, threads are enough to wait on them
+    with ThreadPoolExecutor(max_builds) as executor:
+        for skin in skins:
+            with timer.stage('clone'):
+                skin_folder = clone_decode_folder(decode_folder, os.path.join(output_folder, skin.name))
+            with timer.stage('replace'):
+                replace_resources(skin_folder, skin.ui_folders, os.path.join(output_folder, skin.excel_filename), backend, digest_cache, density_aware)
+            if not store is None:
+                store.commit()
+            builds.append(executor.submit(timed_build_apk, timer, skin_folder, output_folder))
+        build_filepaths = [build.result() for build in builds]
+    if not store is None:
+        store.close()
+    for build_filepath in build_filepaths:
+        print('build apk: ', build_filepath)
+    print(timer.report())
+    return build_filepaths
+
+def timed_build_apk(timer: StageTimer, decode_folder, output_folder):
+    with timer.stage('build'):
+        return build_apk(decode_folder, output_folder)
+
 if __name__ == '__main__':
 
     skin_template_apk = 'D:\\Projects\\GWM_V2\\SkinSwitchTool\\PyProj\\launcher-future-skin-blue.apk'
     ui_folders = ['D:\\Projects\\GWM_V2\\SkinSwitchTool\\PyProj\\common', 'D:\\Projects\\GWM_V2\\SkinSwitchTool\\PyProj\\launcher']
     output_folder = 'D:\\Projects\\GWM_V2\\SkinSwitchTool\\PyProj\\output'
     excel_filename = 'launcher.xlsx'
+    cache_filepath = 'D:\\Projects\\GWM_V2\\SkinSwitchTool\\PyProj\\output\\compare_cache.db'
 
-    main(skin_template_apk, ui_folders, output_folder, excel_filename)
+    main(skin_template_apk, ui_folders, output_folder, excel_filename, cache_filepath)
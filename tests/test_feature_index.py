@@ -0,0 +1,35 @@
+import os
+import sys
+
+import cv2
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyImgFeatures import FeatureIndex, ImageFeatureComparater
+from PyProject01 import ImageHistComparater
+
+def test_changed_file_is_indexed_again(tmp_path):
+    rng = numpy.random.RandomState(0)
+    left = str(tmp_path / 'l.png')
+    right = str(tmp_path / 'r.png')
+    img = rng.randint(0, 128, (32, 32, 3)).astype(numpy.uint8)
+    cv2.imwrite(left, img)
+    cv2.imwrite(right, img)
+    index_file = str(tmp_path / 'features.npy')
+    comparater = ImageFeatureComparater(index = FeatureIndex(index_file))
+    comparater.compare_image_list(left, [right])
+    comparater.save()
+
+    cv2.imwrite(right, rng.randint(128, 256, (32, 32, 3)).astype(numpy.uint8))
+    stat = os.stat(right)
+    os.utime(right, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    comparater = ImageFeatureComparater(index = FeatureIndex(index_file))
+    [(file, diff)] = comparater.compare_image_list(left, [right])
+    expected = ImageHistComparater().compare_image(left, right)
+    assert expected > 0.5
+    assert abs(diff - expected) < 1e-3
+    # the changed row is recomputed in place and saved
+    comparater.save()
+    index = FeatureIndex(index_file)
+    assert index.is_current(index.rows[right], os.stat(right))
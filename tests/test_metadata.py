@@ -0,0 +1,36 @@
+import os
+import sys
+import zlib
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyImgCmp import StructMetadataBackend, PilMetadataBackend
+
+def png_chunk(tag, data):
+    return struct.pack('>L', len(data)) + tag + data + struct.pack('>L', zlib.crc32(tag + data) & 0xffffffff)
+
+def write_png(path, bit_depth, color_type, width = 4, height = 3):
+    """
+    Write a blank png of the given IHDR bit depth and color type
+    """
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    row_bytes = (width * channels * bit_depth + 7) // 8
+    raw = b''.join(b'\0' + bytes(row_bytes) for row in range(height))
+    chunks = png_chunk(b'IHDR', struct.pack('>LLBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+    if 3 == color_type:
+        chunks += png_chunk(b'PLTE', bytes(3 * 2 ** bit_depth))
+    chunks += png_chunk(b'IDAT', zlib.compress(raw)) + png_chunk(b'IEND', b'')
+    with open(path, 'wb') as output:
+        output.write(b'\211PNG\r\n\032\n' + chunks)
+
+@pytest.mark.parametrize('bit_depth, color_type', sorted(StructMetadataBackend.PNG_MODES))
+def test_png_mode_matches_pil(tmp_path, bit_depth, color_type):
+    path = str(tmp_path / 'image.png')
+    write_png(path, bit_depth, color_type)
+    struct_info = StructMetadataBackend(resolve_mode = False).load(path)
+    pil_info = PilMetadataBackend().load(path)
+    assert (struct_info.type, struct_info.width, struct_info.height, struct_info.mode) == \
+        (pil_info.type, pil_info.width, pil_info.height, pil_info.mode)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import cv2
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyImgSSIM import ImageBatchSSIMComparater, header_key
+from PyProject01 import ImageSSIMComparater
+
+def write_nine_patch(path, img):
+    """
+    Write img as a source .9.png, framed by a 1px marker border
+    """
+    bordered = numpy.zeros((img.shape[0] + 2, img.shape[1] + 2, 4), numpy.uint8)
+    bordered[1:-1, 1:-1] = img
+    bordered[0, 5:10] = (0, 0, 0, 255)
+    bordered[5:10, 0] = (0, 0, 0, 255)
+    cv2.imwrite(path, bordered)
+
+def test_batch_ssim_nine_patch(tmp_path):
+    rng = numpy.random.RandomState(0)
+    img = rng.randint(0, 255, (32, 48, 4)).astype(numpy.uint8)
+    noisy = img.copy()
+    noisy[10:14, 10:14] = 0
+    left = str(tmp_path / 'left.9.png')
+    files = [str(tmp_path / 'same.9.png'), str(tmp_path / 'noisy.9.png')]
+    write_nine_patch(left, img)
+    write_nine_patch(files[0], img)
+    write_nine_patch(files[1], noisy)
+
+    assert header_key(left) == (48, 32)
+    expected = ImageSSIMComparater().compare_image_list(left, files)
+    results = ImageBatchSSIMComparater().compare_image_list(left, files)
+    assert [file for file, diff in results] == files
+    for (file, diff), (expected_file, expected_diff) in zip(results, expected):
+        assert abs(diff - expected_diff) < 1e-9
+    assert results[0][1] < 1e-9 < results[1][1]